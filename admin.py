@@ -1,18 +1,140 @@
+import threading
+import uuid
+from django.conf import settings
 from django.contrib import admin
+from django.core.cache import cache
+from django.db import connections, transaction
+from models import STATUS_DRAFT, STATUS_PUBLISHED
 
 """
 Some admin actions for bulk publishing/drafting records
+
+Selections are updated in primary key ordered batches, so no single statement locks
+a whole table's worth of rows, and rows already in the target status are left alone.
+Settings (all optional):
+    
+    MACHETE_ADMIN_BATCH_SIZE                Rows updated per statement (default 1000)
+    MACHETE_ADMIN_BACKGROUND_THRESHOLD      Selections bigger than this are updated in a background
+                                            thread instead of the request (default None, never)
+
 """
 
+def update_status(queryset, status, batch_size=1000, progress=None, commit=False):
+    
+    """
+    Set `status` on every row in `queryset` that isn't already in it, `batch_size`
+    rows at a time in primary key order, each batch its own UPDATE statement.
+    `progress`, if passed, is called with the number of rows updated so far after
+    each batch. Returns the number of rows updated.
+    
+    Committing is left to the caller by default. With `commit=True` each batch is
+    committed as soon as it's done, even inside a managed transaction (e.g. under
+    TransactionMiddleware), so row locks are let go batch by batch instead of being
+    held until the response; anything else in the transaction is committed with the
+    first batch, so only pass it when nothing else is pending, as the admin actions do.
+    """
+    
+    queryset = queryset.exclude(status=status).order_by('pk')
+    manager = queryset.model._default_manager.db_manager(queryset.db)
+    updated = 0
+    last = None
+    
+    while True:
+        batch = queryset if last is None else queryset.filter(pk__gt=last)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        
+        if not pks:
+            break
+        
+        # Rows could have changed status since they were selected. GlobalModel rows
+        # are touch()ed, so the change shows up in their change feed
+        
+        batch = manager.filter(pk__in=pks).exclude(status=status)
+        updated += batch.touch(status=status) if hasattr(batch, 'touch') else batch.update(status=status)
+        last = pks[-1]
+        
+        if commit and transaction.is_managed(using=queryset.db):
+            transaction.commit(using=queryset.db)
+        
+        if progress is not None:
+            progress(updated)
+    
+    return updated
+
+class StatusJob(threading.Thread):
+    
+    """
+    Background thread running update_status(), keeping its progress in the cache
+    under its `job_id` for get_job_progress()
+    """
+    
+    def __init__(self, queryset, status, batch_size=1000, total=None):
+        super(StatusJob, self).__init__()
+        self.daemon = True
+        self.queryset = queryset
+        self.status = status
+        self.batch_size = batch_size
+        self.job_id = uuid.uuid4().hex
+        self.set_progress(total=total, updated=0, done=False)
+    
+    def run(self):
+        try:
+            self.process()
+        finally:
+            # Threads get their own database connections, which are never closed for them
+            connections[self.queryset.db].close()
+    
+    def process(self):
+        updated = update_status(self.queryset, self.status, self.batch_size, lambda updated: self.set_progress(updated=updated), commit=True)
+        self.set_progress(updated=updated, done=True)
+    
+    def set_progress(self, **kwargs):
+        progress = get_job_progress(self.job_id) or {}
+        progress.update(kwargs)
+        cache.set(get_job_cache_key(self.job_id), progress, 60 * 60 * 24)
+
+def get_job_cache_key(job_id):
+    return 'machete.admin.job.%s' % job_id
+
+def get_job_progress(job_id):
+    
+    """
+    Returns a dict with the 'total' rows selected, rows 'updated' so far and whether
+    the job is 'done' for a background status job, or None if there's no such job
+    """
+    
+    return cache.get(get_job_cache_key(job_id))
+
+def set_status(modeladmin, request, queryset, status, label):
+    
+    """
+    Update the selection's status, in the background if it's over the threshold,
+    in which case the StatusJob is returned
+    """
+    
+    batch_size = getattr(settings, 'MACHETE_ADMIN_BATCH_SIZE', 1000)
+    threshold = getattr(settings, 'MACHETE_ADMIN_BACKGROUND_THRESHOLD', None)
+    
+    if threshold is not None:
+        total = queryset.count()
+        if total > threshold:
+            job = StatusJob(queryset, status, batch_size, total)
+            job.start()
+            modeladmin.message_user(request, "Marking %d items as %s in the background (job %s)" % (total, label, job.job_id))
+            return job
+    
+    updated = update_status(queryset, status, batch_size, commit=True)
+    modeladmin.message_user(request, "%d items marked as %s" % (updated, label))
+
 def make_published(modeladmin, request, queryset):
-    queryset.update(status='1')
+    set_status(modeladmin, request, queryset, STATUS_PUBLISHED, 'published')
 
 make_published.short_description = "Mark selected items as published"
 
 def make_draft(modeladmin, request, queryset):
-    queryset.update(status='0')
+    set_status(modeladmin, request, queryset, STATUS_DRAFT, 'draft')
 
 make_draft.short_description = "Mark selected items as draft"
 
 admin.site.add_action(make_published)
-admin.site.add_action(make_draft)
\ No newline at end of file
+admin.site.add_action(make_draft)
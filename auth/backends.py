@@ -1,6 +1,15 @@
-from django.contrib.auth.models import User
+import multiprocessing
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth.models import User, UNUSABLE_PASSWORD, check_password, get_hexdigest
 from django.contrib.auth.backends import ModelBackend
-from django.db.models import Q
+from django.core.cache import cache
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from indexes import filter_email
 
 class ModelBackendFlexible(ModelBackend):
     
@@ -16,12 +25,317 @@ class ModelBackendFlexible(ModelBackend):
             ...
         )
     
+    Logins that look like an email address are looked up by email (case-insensitively,
+    see auth/indexes.py for indexing that), falling back to the username; everything
+    else is looked up by username only. Only the primary key and password are loaded
+    to check the password, the full user is loaded once it checks out.
+    
+    To keep logins cheap under a burst of bad ones (e.g. credential stuffing), which user ids
+    a login belongs to is cached, unknown logins included, and after too many failed attempts
+    a login is rejected before its password is hashed. get_user() is cached too. The caches are
+    cleared when users are saved or deleted, though not by QuerySet.update(). Settings (all optional):
+        
+        MACHETE_AUTH_CACHE_TIMEOUT          Seconds a login's user ids are cached for, 0 turns caching off (default 300)
+        MACHETE_AUTH_NEGATIVE_TIMEOUT       Seconds an unknown login is cached for (default 30)
+        MACHETE_AUTH_MAX_ATTEMPTS           Failed attempts allowed per login, 0 for no limit (default 10)
+        MACHETE_AUTH_ATTEMPT_TIMEOUT        Seconds after the first failed attempt the count starts over (default 300)
+        MACHETE_AUTH_USER_CACHE_TIMEOUT     Seconds get_user() results are cached for, 0 turns caching off (default 60)
+        MACHETE_AUTH_PASSWORD_WORKERS       Number of processes to check passwords in, 0 checks them inline (default 0);
+                                            a check that times out counts as a failed attempt
+    
+    Passwords stored with an older algorithm than the one User.set_password() uses are
+    converted when their user logs in.
+    
     """
     
+    # Most users that can share an email address, their passwords are tried in turn
+    
+    max_email_matches = 10
+    
+    def __init__(self):
+        self.cache_timeout = getattr(settings, 'MACHETE_AUTH_CACHE_TIMEOUT', 300)
+        self.negative_timeout = getattr(settings, 'MACHETE_AUTH_NEGATIVE_TIMEOUT', 30)
+        self.max_attempts = getattr(settings, 'MACHETE_AUTH_MAX_ATTEMPTS', 10)
+        self.attempt_timeout = getattr(settings, 'MACHETE_AUTH_ATTEMPT_TIMEOUT', 300)
+        self.user_cache_timeout = getattr(settings, 'MACHETE_AUTH_USER_CACHE_TIMEOUT', 60)
+    
     def authenticate(self, username=None, password=None):
-        try:
-            user = User.objects.get(Q(username=username) | Q(email=username))
-            if user.check_password(password):
+        
+        if not username or password is None:
+            return None
+        
+        if self.max_attempts and self.get_attempts(username) >= self.max_attempts:
+            return None
+        
+        for user_id, encoded in self.get_candidates(username):
+            if self.verify_password(password, encoded):
+                try:
+                    user = User.objects.get(pk=user_id)
+                except User.DoesNotExist:
+                    return None
+                if needs_rehash(user.password):
+                    user.set_password(password)
+                    user.save()
+                if self.max_attempts:
+                    cache.delete_many(get_attempt_keys(username))
                 return user
-        except User.DoesNotExist:
-            return None
\ No newline at end of file
+        
+        if self.max_attempts:
+            self.add_attempt(username)
+        
+        return None
+    
+    def get_attempts(self, username):
+        
+        """
+        Returns the number of failed attempts for a login in the current window
+        """
+        
+        count_key, started_key = get_attempt_keys(username)
+        values = cache.get_many([count_key, started_key])
+        started = values.get(started_key)
+        
+        if started is None or time.time() - started >= self.attempt_timeout:
+            return 0
+        
+        return values.get(count_key, 0)
+    
+    def add_attempt(self, username):
+        
+        """
+        Count a failed attempt for a login. The window is timed from the first failure's
+        timestamp rather than left to the count's expiry, since incr() on backends other
+        than memcached sets the count again with the cache's default timeout.
+        """
+        
+        count_key, started_key = get_attempt_keys(username)
+        now = time.time()
+        started = cache.get(started_key)
+        
+        if started is None or now - started >= self.attempt_timeout:
+            cache.set_many({count_key: 1, started_key: now}, self.attempt_timeout)
+            return
+        
+        # incr() rather than get() and set(), so concurrent failures all count on
+        # backends with an atomic incr(), like memcached
+        
+        try:
+            cache.incr(count_key)
+        except ValueError:
+            # Expired in between
+            cache.add(count_key, 1, self.attempt_timeout)
+    
+    def get_user(self, user_id):
+        
+        if not self.user_cache_timeout:
+            return super(ModelBackendFlexible, self).get_user(user_id)
+        
+        key = get_cache_key('user', user_id)
+        user = cache.get(key)
+        
+        if user is None:
+            user = super(ModelBackendFlexible, self).get_user(user_id)
+            if user is not None:
+                cache.set(key, user, self.user_cache_timeout)
+        
+        return user
+    
+    def get_candidates(self, username):
+        
+        """
+        Returns a list of (user id, encoded password) tuples for the users a
+        login could belong to, going by the cached user ids if there are any
+        """
+        
+        if not self.cache_timeout:
+            return self.find_candidates(username)
+        
+        key = get_cache_key('login', normalize_login(username))
+        cached = cache.get(key)
+        
+        if cached is not None:
+            
+            # Email-style logins share a key whatever their case, but a username
+            # containing '@' is still matched exactly, so an unknown login only
+            # counts for the spelling it was looked up with
+            
+            cached_username, user_ids = cached
+            
+            if not user_ids and cached_username == username:
+                return []
+            
+            if user_ids:
+                
+                # Users may have changed their username or email since
+                
+                users = User.objects.filter(pk__in=user_ids).order_by('pk').values_list('pk', 'password', 'username', 'email')
+                candidates = [(user_id, encoded,) for user_id, encoded, user_username, email in users if username == user_username or username.lower() == email.lower()]
+                
+                if candidates:
+                    return candidates
+        
+        candidates = self.find_candidates(username)
+        cache.set(key, (username, [user_id for user_id, encoded in candidates],), self.cache_timeout if candidates else self.negative_timeout)
+        return candidates
+    
+    def find_candidates(self, username):
+        
+        """
+        Look up the (user id, encoded password) tuples for the users a login
+        could belong to, each lookup hitting a single indexed column
+        """
+        
+        users = User.objects.values_list('pk', 'password')
+        
+        if '@' in username:
+            candidates = list(filter_email(users, username).order_by('pk')[:self.max_email_matches])
+            if candidates:
+                return candidates
+        
+        return list(users.filter(username=username))
+    
+    def verify_password(self, raw_password, encoded):
+        verifier = get_password_verifier()
+        if verifier is not None:
+            return verifier.verify(raw_password, encoded)
+        return verify_password(raw_password, encoded)
+
+# ---- PASSWORDS
+
+# Algorithm User.set_password() hashes with
+
+PASSWORD_ALGORITHM = 'sha1'
+
+def verify_password(raw_password, encoded):
+    
+    """
+    Same check as User.check_password(), without needing a User instance
+    """
+    
+    if '$' not in encoded:
+        return constant_time_compare(encoded, get_hexdigest('md5', '', raw_password))
+    return check_password(raw_password, encoded)
+
+def needs_rehash(encoded):
+    
+    """
+    Whether a password was hashed with an algorithm other than the current one, e.g. an
+    unsalted md5 hash from an old Django version or a 'crypt' one from an imported user table
+    """
+    
+    return encoded.split('$', 1)[0] != PASSWORD_ALGORITHM and encoded != UNUSABLE_PASSWORD
+
+class PasswordVerifier(object):
+    
+    """
+    Checks passwords on a bounded pool of worker processes, so hashing them doesn't hold
+    on to the GIL of the process serving requests; the calling thread just waits for the
+    answer while other requests run. Worth it with slow hashes only, since each check
+    costs a round trip to a worker process.
+    
+    `workers`   Number of worker processes, started on first use
+    `timeout`   Seconds verify() waits for an answer before counting the password as wrong,
+                which ModelBackendFlexible counts as a failed attempt towards its lockout
+    """
+    
+    def __init__(self, workers=2, timeout=10):
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+    
+    def verify(self, raw_password, encoded):
+        try:
+            return self.verify_async(raw_password, encoded).get(self.timeout)
+        except multiprocessing.TimeoutError:
+            return False
+    
+    def verify_async(self, raw_password, encoded, callback=None):
+        
+        """
+        Start checking a password and return straight away, for event loops and the like.
+        Returns a multiprocessing AsyncResult; `callback`, if passed, is called with True or
+        False from a pool thread when the check is done.
+        """
+        
+        return self.get_pool().apply_async(verify_password, (raw_password, encoded,), callback=callback)
+    
+    def get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.workers)
+        return self._pool
+    
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+# Shared verifier for ModelBackendFlexible
+
+password_verifier = None
+password_verifier_lock = threading.Lock()
+
+def get_password_verifier():
+    global password_verifier
+    workers = getattr(settings, 'MACHETE_AUTH_PASSWORD_WORKERS', 0)
+    if not workers:
+        return None
+    with password_verifier_lock:
+        if password_verifier is None:
+            password_verifier = PasswordVerifier(workers)
+        return password_verifier
+
+# ---- CACHING
+
+def get_cache_key(kind, value):
+    return 'machete.auth.%s.%s' % (kind, md5_constructor(smart_str(value)).hexdigest())
+
+def normalize_login(username):
+    
+    """
+    Email-style logins are matched case-insensitively, so they're cached under their lowercase form
+    """
+    
+    return username.lower() if '@' in username else username
+
+def get_attempt_keys(username):
+    
+    """
+    Returns the cache keys for a login's failed attempt count and the time of its first failure
+    """
+    
+    username = username.lower()
+    return get_cache_key('attempts', username), get_cache_key('attempts_started', username)
+
+def remember_user_logins(sender, instance, **kwargs):
+    
+    """
+    Note the username and email a user is stored with before it's saved, so
+    clear_user_cache() can forget the logins it's being changed from
+    """
+    
+    if instance.pk is not None:
+        instance._machete_stored_logins = list(User.objects.filter(pk=instance.pk).values_list('username', 'email'))
+
+def clear_user_cache(sender, instance, **kwargs):
+    
+    """
+    Forget the cached user and the logins it could be looked up by, before and after the save
+    """
+    
+    logins = [(instance.username, instance.email,)] + getattr(instance, '_machete_stored_logins', [])
+    keys = [get_cache_key('user', instance.pk)]
+    
+    for username, email in logins:
+        keys.append(get_cache_key('login', normalize_login(username)))
+        if email:
+            keys.append(get_cache_key('login', normalize_login(email)))
+    
+    cache.delete_many(keys)
+
+pre_save.connect(remember_user_logins, sender=User, dispatch_uid='machete.auth.remember_user_logins')
+post_save.connect(clear_user_cache, sender=User, dispatch_uid='machete.auth.clear_user_cache')
+post_delete.connect(clear_user_cache, sender=User, dispatch_uid='machete.auth.clear_user_cache')
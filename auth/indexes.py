@@ -0,0 +1,76 @@
+from django.contrib.auth.models import User
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+"""
+Case-insensitive index on auth_user.email, so the email lookups in ModelBackendFlexible
+(see filter_email()) don't scan the whole user table. Django doesn't index that column, so
+create it once per database with the 'create_email_index' management command, or from a
+migration, e.g. with South:
+    
+    def forwards(self, orm):
+        create_email_index()
+    
+    def backwards(self, orm):
+        drop_email_index()
+
+"""
+
+EMAIL_INDEX_NAME = 'auth_user_email_ci'
+
+# Each backend's iexact lookup is matched by a different kind of index
+
+EMAIL_INDEX_SQL = {
+    'postgresql': 'CREATE INDEX %(name)s ON %(table)s (UPPER(%(column)s::text))',
+    'oracle': 'CREATE INDEX %(name)s ON %(table)s (UPPER(%(column)s))',
+    'mysql': 'CREATE INDEX %(name)s ON %(table)s (%(column)s)', # Case-insensitive collations are the default
+    'sqlite': 'CREATE INDEX %(name)s ON %(table)s (%(column)s COLLATE NOCASE)',
+}
+
+DROP_INDEX_SQL = {
+    'mysql': 'DROP INDEX %(name)s ON %(table)s',
+}
+
+def filter_email(queryset, email):
+    
+    """
+    Filter a User QuerySet by email, case-insensitively, in the form the email index matches.
+    That's email__iexact everywhere but SQLite, where it turns into a LIKE that can't use
+    the index, so an equality comparison with the index's collation is used instead. Both
+    fold ASCII letters only on SQLite.
+    """
+    
+    connection = connections[queryset.db]
+    
+    if connection.vendor == 'sqlite':
+        column = '%s.%s' % (connection.ops.quote_name(User._meta.db_table), connection.ops.quote_name(User._meta.get_field('email').column))
+        return queryset.extra(where=['%s = %%s COLLATE NOCASE' % column], params=[email])
+    
+    return queryset.filter(email__iexact=email)
+
+def get_email_index_sql(using=DEFAULT_DB_ALIAS, drop=False):
+    
+    """
+    Returns the SQL creating (or dropping) the email index for a database
+    """
+    
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    
+    if connection.vendor not in EMAIL_INDEX_SQL:
+        raise ValueError("Don't know how to index emails on %s" % connection.vendor)
+    
+    sql = DROP_INDEX_SQL.get(connection.vendor, 'DROP INDEX %(name)s') if drop else EMAIL_INDEX_SQL[connection.vendor]
+    
+    return sql % {
+        'name': quote(EMAIL_INDEX_NAME),
+        'table': quote(User._meta.db_table),
+        'column': quote(User._meta.get_field('email').column),
+    }
+
+def create_email_index(using=DEFAULT_DB_ALIAS):
+    connections[using].cursor().execute(get_email_index_sql(using))
+    transaction.commit_unless_managed(using=using)
+
+def drop_email_index(using=DEFAULT_DB_ALIAS):
+    connections[using].cursor().execute(get_email_index_sql(using, drop=True))
+    transaction.commit_unless_managed(using=using)
@@ -0,0 +1,262 @@
+import timeit
+from django.template import Context, Template
+from columns import chunk, columnize, grid
+
+"""
+Micro-benchmarks for machete's hot spots. They need configured Django settings
+with machete in INSTALLED_APPS, so run them from a project shell:
+
+    python manage.py shell
+    >>> from machete import benchmarks
+    >>> benchmarks.run()
+
+"""
+
+def timed(func, number, repeat=3):
+    
+    """
+    Returns the best time in seconds for `number` calls of `func`
+    """
+    
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+def report(name, seconds, per, unit):
+    print '%-40s %10.2f ms  %8.2f us/%s' % (name, seconds * 1000, seconds * 1000000 / per, unit)
+
+# ---- COLUMNS
+
+def bench_columns(items=100000, columns=4):
+    
+    """
+    Split a big list with each of the columns.py functions
+    """
+    
+    items = range(0, items)
+    
+    for name, func in (
+        ('columnize (alternating)', lambda: columnize(items, columns)),
+        ('columnize (stacked)', lambda: columnize(items, columns, stacked=True)),
+        ('chunk', lambda: chunk(items, columns)),
+        ('grid (stacked)', lambda: grid(items, columns, stacked=True)),
+    ):
+        seconds = timed(func, 10) / 10
+        report('%s (%d items)' % (name, len(items)), seconds, len(items), 'item')
+
+# ---- FILTERS
+
+def bench_twitterize(tweets=200):
+    
+    """
+    Twitterize a wall of tweets, with and without the memoized results
+    """
+    
+    from templatetags.machete import twitterize, twitterize_cache
+    
+    texts = [u'Tweet number %d from @cubancouncil about #django and #python, see http://example.com/%d and www.example.org' % (i, i) for i in range(0, tweets)]
+    
+    def uncached():
+        twitterize_cache.clear()
+        for text in texts:
+            twitterize(text)
+    
+    def cached():
+        for text in texts:
+            twitterize(text)
+    
+    report('twitterize (%d tweets)' % tweets, timed(uncached, 10) / 10, tweets, 'tweet')
+    report('twitterize memoized (%d tweets)' % tweets, timed(cached, 10) / 10, tweets, 'tweet')
+
+# ---- TWITTER
+
+def bench_parse_tweets(tweets=2000):
+    
+    """
+    Decode and post-process a big recorded-style timeline response, the old way (list.index()
+    and strptime() per tweet), into dicts, and into compact Tweet records
+    """
+    
+    import simplejson
+    from datetime import datetime
+    from twitter import Tweet, parse_tweets
+    
+    tweet = '{"id": %d, "text": "Tweet number %d about #django, see http://t.co/abc", "created_at": "Thu Dec 22 19:30:11 +0000 2011", "source": "web", "retweet_count": 0, "in_reply_to_screen_name": null, "in_reply_to_status_id": null, "user": {"id": 1, "screen_name": "cubancouncil"}, "entities": {"hashtags": [], "urls": [], "user_mentions": []}, "favorited": false, "truncated": false}'
+    data = '[%s]' % ', '.join(tweet % (i, i) for i in range(0, tweets))
+    
+    def old():
+        tweets = simplejson.loads(data)
+        for tweet in tweets:
+            idx = tweets.index(tweet)
+            tweets[idx]['created_at'] = datetime.strptime(tweets[idx]['created_at'], '%a %b %d %H:%M:%S +0000 %Y')
+    
+    report('parse_tweets old (%d tweets)' % tweets, timed(old, 1), tweets, 'tweet')
+    report('parse_tweets (%d tweets)' % tweets, timed(lambda: parse_tweets(simplejson.loads(data)), 10) / 10, tweets, 'tweet')
+    report('parse_tweets Tweet (%d tweets)' % tweets, timed(lambda: parse_tweets(simplejson.loads(data), Tweet), 10) / 10, tweets, 'tweet')
+
+# ---- SPATIAL
+
+def bench_spatial(points=1000000, queries=100):
+    
+    """
+    Build a grid index of a million random US points, then run nearest and radius queries
+    against it, next to a plain haversine over every point
+    """
+    
+    import random
+    from spatial import GridIndex, haversine
+    
+    random.seed(1)
+    coordinates = [(random.uniform(-125, -67), random.uniform(25, 49)) for i in range(0, points)]
+    origins = coordinates[:queries]
+    index = GridIndex(0.1)
+    
+    def build():
+        for key, point in enumerate(coordinates):
+            index.add(key, point)
+    
+    report('GridIndex build (%d points)' % points, timed(build, 1, 1), points, 'point')
+    report('GridIndex nearest 10 (%d points)' % points, timed(lambda: [index.nearest(origin, 10) for origin in origins], 1), queries, 'query')
+    report('GridIndex within 25 km (%d points)' % points, timed(lambda: [index.within(origin, 25) for origin in origins], 1), queries, 'query')
+    report('haversine scan (%d points)' % points, timed(lambda: sorted(haversine(origins[0], point) for point in coordinates)[:10], 1, 1), 1, 'query')
+
+# ---- MODELS
+
+def bench_published_recent(rows=500000, published=0.3):
+    
+    """
+    Query plans and timings for the get_published_recent() query (first page, full rows and pks only)
+    on a big GlobalModel-shaped SQLite table, with Django's plain status index, then the composite
+    index, then the partial index from indexes.py
+    """
+    
+    import random
+    import sqlite3
+    from indexes import COMPOSITE_INDEX_SQL, PARTIAL_INDEX_SQL
+    
+    random.seed(1)
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE article (id INTEGER PRIMARY KEY, title VARCHAR(100), created DATETIME, modified DATETIME, status SMALLINT)')
+    db.execute('CREATE INDEX article_status ON article (status)')
+    db.executemany('INSERT INTO article VALUES (?, ?, ?, ?, ?)', (
+        (i, 'Article %d' % i, '2011-%02d-%02d %02d:00:00' % (random.randint(1, 12), random.randint(1, 28), random.randint(0, 23)), '2012-01-01 00:00:00', int(random.random() < published))
+        for i in range(1, rows + 1)
+    ))
+    
+    params = {'table': 'article', 'status': 'status', 'created': 'created', 'pk': 'id', 'published': 1}
+    queries = (
+        ('rows', 'SELECT * FROM article WHERE status = 1 ORDER BY created DESC, id DESC LIMIT 20'),
+        ('pks', 'SELECT id FROM article WHERE status = 1 ORDER BY created DESC, id DESC LIMIT 20'),
+    )
+    
+    for name, sql in (('status index', None), ('composite index', COMPOSITE_INDEX_SQL), ('partial index', PARTIAL_INDEX_SQL)):
+        if sql is not None:
+            db.execute('DROP INDEX IF EXISTS recent')
+            db.execute(sql % dict(params, name='recent'))
+        db.execute('ANALYZE')
+        for query_name, query in queries:
+            plan = '; '.join(row[-1] for row in db.execute('EXPLAIN QUERY PLAN %s' % query))
+            report('published recent %s, %s (%d rows)' % (query_name, name, rows), timed(lambda: db.execute(query).fetchall(), 10) / 10, 1, 'query')
+            print '    %s' % plan
+
+# ---- AUTH
+
+def bench_passwords(checks=2000, threads=4, workers=4):
+    
+    """
+    Password check throughput from `threads` request threads, checking inline and on a
+    PasswordVerifier pool, for Django's default sha1 hashes and for 'crypt' ones
+    """
+    
+    import threading
+    from django.contrib.auth.models import get_hexdigest
+    from auth.backends import PasswordVerifier, verify_password
+    
+    verifier = PasswordVerifier(workers)
+    verifier.verify('warm', 'sha1$abc$def') # Start the pool up
+    
+    for algorithm in ('sha1', 'crypt'):
+        encoded = '%s$ab$%s' % (algorithm, get_hexdigest(algorithm, 'ab', 'secret'))
+        
+        for name, verify in (('inline', verify_password), ('pool', verifier.verify)):
+            
+            def run():
+                def work():
+                    for i in range(0, checks // threads):
+                        verify('secret', encoded)
+                pool = [threading.Thread(target=work) for i in range(0, threads)]
+                for thread in pool:
+                    thread.start()
+                for thread in pool:
+                    thread.join()
+            
+            report('password check %s %s (%d threads)' % (algorithm, name, threads), timed(run, 1), checks, 'check')
+    
+    verifier.close()
+
+# ---- TEMPLATE TAGS
+
+def bench_querystring(links=500):
+    
+    """
+    Render a facet sidebar worth of {% querystring %} links off a single base query string
+    """
+    
+    template = Template('{% load machete %}{% for facet in facets %}<a href="{% querystring qs facet=facet page=None %}">{{ facet }}</a>{% endfor %}')
+    context = {
+        'qs': {'q': 'tom waits', 'page': 3, 'sort': 'date', 'artists[]': range(0, 10), 'year': 2011},
+        'facets': ['facet-%d' % i for i in range(0, links)],
+    }
+    
+    seconds = timed(lambda: template.render(Context(context)), 10) / 10
+    report('querystring (%d links)' % links, seconds, links, 'link')
+
+def bench_querystrings(links=500):
+    
+    """
+    Same sidebar as bench_querystring(), built with a single {% querystrings %} tag
+    """
+    
+    template = Template('{% load machete %}{% querystrings qs page=None for facet in facets as links %}{% for facet, link in links %}<a href="{{ link }}">{{ facet }}</a>{% endfor %}')
+    context = {
+        'qs': {'q': 'tom waits', 'page': 3, 'sort': 'date', 'artists[]': range(0, 10), 'year': 2011},
+        'facets': ['facet-%d' % i for i in range(0, links)],
+    }
+    
+    seconds = timed(lambda: template.render(Context(context)), 10) / 10
+    report('querystrings (%d links)' % links, seconds, links, 'link')
+
+def bench_tag(name, template_string, context, renders=1000):
+    
+    """
+    Time `renders` renders of a single tag
+    """
+    
+    template = Template('{% load machete %}' + template_string)
+    context = Context(context)
+    seconds = timed(lambda: template.render(context), renders)
+    report(name, seconds, renders, 'render')
+
+def bench_tags():
+    
+    """
+    Per-render cost of each tag, on small inputs so the tag overhead itself shows
+    """
+    
+    qs = {'q': 'tom waits', 'page': 3, 'sort': 'date', 'artists[]': range(0, 10)}
+    
+    bench_tag('querystring (no arguments)', '{% querystring qs %}', {'qs': qs})
+    bench_tag('querystring (literal arguments)', "{% querystring qs page=None sort='title' artists[]+=11 %}", {'qs': qs})
+    bench_tag('querystring (variable arguments)', '{% querystring qs page=page sort=sort %}', {'qs': qs, 'page': 4, 'sort': 'title'})
+    bench_tag('columnize (alternating)', '{% columnize items into 4 as columns %}', {'items': range(0, 100)})
+    bench_tag('columnize (stacked)', '{% columnize items into 4 stacked as columns %}', {'items': range(0, 100)})
+    bench_tag('truncatestring', '{% truncatestring text 20 %}', {'text': 'Hello there, how are you doing on this fine day?'})
+
+def run():
+    bench_columns()
+    bench_twitterize()
+    bench_parse_tweets()
+    bench_spatial()
+    bench_published_recent()
+    bench_passwords()
+    bench_querystring()
+    bench_querystrings()
+    bench_tags()
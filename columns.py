@@ -0,0 +1,175 @@
+from itertools import islice, izip_longest
+
+"""
+Functions for splitting lists into columns, chunks and grids, used by the 'columnize'
+template tag and handy in views and API serializers too.
+
+All of them work out the boundaries arithmetically and slice, rather than appending
+one item at a time, so they take a handful of operations per column or row no matter
+how long the list is.
+"""
+
+def column_bounds(total, columns):
+    
+    """
+    Returns a list of (start, end) index tuples for splitting `total` items into `columns`
+    stacked columns, with the first columns getting an extra item when it doesn't split evenly
+    
+    Example:
+        
+        column_bounds(5, 3) yields [(0, 2), (2, 4), (4, 5)]
+    
+    """
+    
+    size, rem = divmod(total, columns)
+    bounds = []
+    start = 0
+    
+    for column in range(columns):
+        end = start + size + (1 if column < rem else 0)
+        bounds.append((start, end,))
+        start = end
+    
+    return bounds
+
+def columnize(items, columns, stacked=False):
+    
+    """
+    Split `items` into a list of `columns` lists. By default items are dealt out by alternating
+    through the columns; with `stacked` the items are broken into columns in their original order.
+    
+    Example:
+        
+        columnize([1, 2, 3, 4, 5], 3) yields [[1, 4], [2, 5], [3]]
+        columnize([1, 2, 3, 4, 5], 3, stacked=True) yields [[1, 2], [3, 4], [5]]
+    
+    """
+    
+    if not isinstance(items, list):
+        items = list(items)
+    
+    if stacked:
+        return [items[start:end] for start, end in column_bounds(len(items), columns)]
+    
+    return [items[column::columns] for column in range(columns)]
+
+def chunk(items, size):
+    
+    """
+    Split `items` into consecutive lists of `size` items, the last one holding whatever is left
+    
+    Example:
+        
+        chunk([1, 2, 3, 4, 5], 2) yields [[1, 2], [3, 4], [5]]
+    
+    """
+    
+    if not isinstance(items, list):
+        items = list(items)
+    
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def grid(items, columns, stacked=False, fill=None):
+    
+    """
+    Lay `items` out as rows of `columns` cells, e.g. for an HTML table. Items run across the
+    rows by default, or down the columns with `stacked`. Empty cells in the last row (or the
+    last cells of the short columns, when stacked) are set to `fill`.
+    
+    Example:
+        
+        grid([1, 2, 3, 4, 5], 3) yields [[1, 2, 3], [4, 5, None]]
+        grid([1, 2, 3, 4, 5], 3, stacked=True) yields [[1, 3, 5], [2, 4, None]]
+    
+    """
+    
+    if stacked:
+        return [list(row) for row in izip_longest(*columnize(items, columns, stacked=True), fillvalue=fill)]
+    
+    rows = chunk(items, columns)
+    
+    if rows and len(rows[-1]) < columns:
+        rows[-1].extend([fill] * (columns - len(rows[-1])))
+    
+    return rows
+
+# ---- LAZY COLUMNS
+
+class StridedColumn(object):
+    
+    """
+    Lazy column holding every `step`th item of a QuerySet, starting at `start`. Each time the
+    column is iterated over, it runs its own full scan of the QuerySet's primary keys, picks
+    out every `step`th one and fetches those rows `chunk_size` at a time, keeping the QuerySet's
+    order. Only the column's own rows become model instances, and nothing is kept in a result
+    cache afterwards.
+    
+    Note that most database drivers (psycopg2, MySQLdb) fetch the whole result set into the client
+    when a query runs, so every primary key still passes through memory once per column.
+    """
+    
+    chunk_size = 100
+    
+    def __init__(self, queryset, start, step, total):
+        self.queryset = queryset
+        self.start = start
+        self.step = step
+        self.total = total
+    
+    def __iter__(self):
+        pks = islice(self.queryset.values_list('pk', flat=True).iterator(), self.start, self.total, self.step)
+        
+        while True:
+            chunk = list(islice(pks, self.chunk_size))
+            
+            if not chunk:
+                return
+            
+            objs = self.queryset.in_bulk(chunk)
+            
+            for pk in chunk:
+                if pk in objs:
+                    yield objs[pk]
+    
+    def __len__(self):
+        return max(0, (self.total - self.start + self.step - 1) // self.step)
+
+class SlicedColumn(object):
+    
+    """
+    Lazy column holding items `start` to `end` of a QuerySet. Each iteration runs a LIMIT/OFFSET
+    query with QuerySet.iterator(), so the rows aren't kept in a result cache once the column's been used.
+    """
+    
+    def __init__(self, queryset, start, end):
+        self.queryset = queryset
+        self.start = start
+        self.end = end
+    
+    def __iter__(self):
+        return self.queryset[self.start:self.end].iterator()
+    
+    def __len__(self):
+        return self.end - self.start
+
+def lazy_columnize(queryset, columns, stacked=False):
+    
+    """
+    Split a QuerySet into columns without evaluating it, using a COUNT query to size the columns.
+    
+    Stacked columns are SlicedColumn instances, costing one LIMIT/OFFSET query each time they're
+    iterated over. Alternating columns are StridedColumn instances, each running its own full scan of
+    the QuerySet's primary keys when iterated over, then fetching its rows by primary key. Neither keeps
+    model instances around once iterated, though with client-side cursors (psycopg2, MySQLdb) each
+    query's rows are still buffered by the driver.
+    """
+    
+    total = queryset.count()
+    
+    if not total:
+        return []
+    
+    if stacked:
+        return [SlicedColumn(queryset, start, end) if end > start else [] for start, end in column_bounds(total, columns)]
+    
+    return [StridedColumn(queryset, column, columns, total) for column in range(columns)]
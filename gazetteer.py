@@ -0,0 +1,185 @@
+import csv
+import mmap
+import os
+import tempfile
+import threading
+from array import array
+from google_maps import get_geo_point, normalize_location
+from spatial import GridIndex
+
+"""
+Offline geocoder, looking addresses up in a local gazetteer CSV file instead of asking
+Google. Point the MACHETE_GEOCODE_GAZETTEER setting at one and google_maps.find_geo(),
+find_geo_point() and the batch functions use it, e.g. for imports and tests.
+
+The CSV file has an address, longitude and latitude on each row (an optional header
+row is skipped):
+    
+    address,lng,lat
+    "Portland, OR, USA",-122.676,45.523
+    "Los Angeles, CA, USA",-118.243,34.052
+
+"""
+
+class Gazetteer(object):
+    
+    """
+    Forward and reverse geocoder backed by a gazetteer CSV file.
+    
+    The first time a CSV file is loaded (and whenever it changes) it's sorted by normalized
+    address into an index file next to it. The index file is memory-mapped and binary searched,
+    so lookups read a few pages off disk instead of loading the gazetteer into memory; only
+    the line offsets are held in memory. Reverse lookups build a GridIndex of every point
+    the first time they're needed.
+    
+    `path`          Path of the gazetteer CSV file
+    `index_path`    Where to keep the sorted index, defaults to the CSV path plus '.index'
+    `cell_size`     Cell size in degrees of the reverse lookup GridIndex
+    """
+    
+    def __init__(self, path, index_path=None, cell_size=0.1):
+        self.path = path
+        self.index_path = index_path or '%s.index' % path
+        self.cell_size = cell_size
+        self._spatial = None
+        self._lock = threading.Lock()
+        
+        if not os.path.exists(self.index_path) or os.path.getmtime(self.index_path) < os.path.getmtime(self.path):
+            self.build_index()
+        
+        self._file = open(self.index_path, 'rb')
+        size = os.path.getsize(self.index_path)
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else ''
+        self._offsets = array('l')
+        
+        position = 0
+        while position < size:
+            self._offsets.append(position)
+            position = self._map.find('\n', position) + 1
+    
+    def __len__(self):
+        return len(self._offsets)
+    
+    def build_index(self):
+        
+        """
+        Write the index file: a 'normalized address<TAB>address<TAB>lng<TAB>lat' line
+        for each gazetteer entry, sorted by normalized address. The first entry wins
+        when several normalize to the same address.
+        """
+        
+        entries = []
+        
+        with open(self.path, 'rb') as gazetteer:
+            for row in csv.reader(gazetteer):
+                try:
+                    address, lng, lat = row[0], float(row[1]), float(row[2])
+                except (IndexError, ValueError):
+                    continue # Header or broken row
+                address = ' '.join(address.decode('utf-8').split())
+                key = normalize_location(address)
+                if key:
+                    entries.append((key.encode('utf-8'), address.encode('utf-8'), lng, lat,))
+        
+        entries.sort(key=lambda entry: entry[0])
+        
+        # Write to a temporary file of its own first, so other threads and processes
+        # building at the same time never see (or truncate) half an index
+        
+        descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp', prefix='%s.' % os.path.basename(self.index_path), dir=os.path.dirname(os.path.abspath(self.index_path)))
+        
+        with os.fdopen(descriptor, 'wb') as index:
+            previous = None
+            for entry in entries:
+                if entry[0] != previous:
+                    index.write('%s\t%s\t%r\t%r\n' % entry)
+                    previous = entry[0]
+        
+        # mkstemp() files are only readable by their owner
+        
+        os.chmod(temporary_path, 0644)
+        os.rename(temporary_path, self.index_path)
+    
+    def find_geo(self, location):
+        
+        """
+        Look an address up, returning geo information shaped like Google's
+        (see google_maps.find_geo()), or False if it's not in the gazetteer
+        """
+        
+        entry = self.lookup(location)
+        
+        if entry is None:
+            return False
+        
+        address, lng, lat = entry
+        return {'Status': {'code': 200}, 'Placemark': [{'address': address, 'Point': {'coordinates': [lng, lat, 0]}}]}
+    
+    def find_geo_point(self, location):
+        return get_geo_point(self.find_geo(location))
+    
+    def lookup(self, location):
+        
+        """
+        Returns an (address, lng, lat) tuple for an address, or None if it's not in the gazetteer
+        """
+        
+        key = normalize_location(location).encode('utf-8')
+        
+        if not key:
+            return None
+        
+        low, high = 0, len(self._offsets)
+        
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        
+        if low < len(self._offsets) and self._get_key(low) == key:
+            return self._get_entry(self._offsets[low])
+        
+        return None
+    
+    def reverse_geo_point(self, point, max_distance=None):
+        
+        """
+        Find the gazetteer entry nearest to a (longitude, latitude) point, optionally no
+        more than `max_distance` km away. Returns a tuple with the address and a tuple
+        containing its longitude/latitude, like find_geo_point(), or False if there's none.
+        """
+        
+        nearest = self.get_spatial_index().nearest(point, 1, radius=max_distance)
+        
+        if not nearest:
+            return False
+        
+        address, lng, lat = self._get_entry(nearest[0][1])
+        return (address, (lng, lat,),)
+    
+    def get_spatial_index(self):
+        
+        """
+        Returns a GridIndex of line offset: point for every entry, building it on first use
+        """
+        
+        with self._lock:
+            if self._spatial is None:
+                spatial = GridIndex(self.cell_size)
+                for offset in self._offsets:
+                    address, lng, lat = self._get_entry(offset)
+                    spatial.add(offset, (lng, lat,))
+                self._spatial = spatial
+        
+        return self._spatial
+    
+    def _get_key(self, i):
+        offset = self._offsets[i]
+        return self._map[offset:self._map.find('\t', offset)]
+    
+    def _get_entry(self, offset):
+        line = self._map[offset:self._map.find('\n', offset)]
+        key, address, lng, lat = line.split('\t')
+        return address.decode('utf-8'), float(lng), float(lat)
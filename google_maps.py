@@ -1,12 +1,46 @@
+import httplib
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from Queue import Queue, Empty
 import simplejson
 from urllib import urlencode
 from urllib2 import urlopen
 from django.conf import settings
+from django.utils.encoding import smart_str, smart_unicode
+from memoize import LRUCache, missing
 
 """
 Handy Google maps geocode search functions
+
+Results are cached by normalized address, in process and optionally in a local SQLite
+file shared by every process on the machine, see GeocodeCache.
+
+Settings (all optional, besides GOOGLE_MAPS_API_KEY):
+    
+    MACHETE_GEOCODER_URL                Geocoder URL, e.g. to point at a local stand-in server for tests
+    MACHETE_GEOCODE_CACHE_PATH          Path of the SQLite file to keep results in, None for in-process only (default)
+    MACHETE_GEOCODE_CACHE_SIZE          Number of results kept in process (default 1000)
+    MACHETE_GEOCODE_CACHE_TIMEOUT       Seconds results are cached for (default 30 days)
+    MACHETE_GEOCODE_NEGATIVE_TIMEOUT    Seconds "no such address" results are cached for (default 1 day)
+    MACHETE_GEOCODE_RATE                Queries per second batch_find_geo() is allowed to make (default 10)
+    MACHETE_GEOCODE_GAZETTEER           Path of a gazetteer CSV file to geocode from instead of Google, see gazetteer.py
+
 """
 
+GEOCODER_URL = 'http://maps.google.com/maps/geo'
+
+# Status codes meaning the address can't be geocoded (missing, unknown or unavailable
+# address), as opposed to errors like a bad key or going over the query limit
+
+NO_RESULT_CODES = (601, 602, 603,)
+
+class GeocodeError(Exception):
+    pass
+
 def find_geo_point(location):
     
     """
@@ -14,7 +48,13 @@ def find_geo_point(location):
     or False if no result found
     """
     
-    geo_content = find_geo(location)
+    return get_geo_point(find_geo(location))
+
+def get_geo_point(geo_content):
+    
+    """
+    Pull the canonical address and longitude/latitude out of a find_geo() result
+    """
     
     if geo_content:
         placemark = geo_content['Placemark'][0]
@@ -26,27 +66,324 @@ def find_geo_point(location):
 def find_geo(location):
     
     """
-    Query Google maps for geo information
+    Query Google maps for geo information, or get it from the cache. The returned
+    dict is shared with the cache, so don't modify it.
+    """
+    
+    key = normalize_location(location)
+    
+    if not key:
+        return False
+    
+    cache = get_geocode_cache()
+    geo_content = cache.get(key)
+    
+    if geo_content is missing:
+        try:
+            geo_content = query_geo(location)
+        except GeocodeError:
+            return False
+        cache.set(key, geo_content)
+    
+    return geo_content
+
+def query_geo(location):
+    
     """
- 
+    Query Google maps (or the gazetteer, if one is set up) for geo information, skipping the
+    cache. Returns False if the address can't be geocoded and raises GeocodeError if the query fails.
+    """
+    
+    gazetteer = get_gazetteer()
+    
+    if gazetteer is not None:
+        return gazetteer.find_geo(location)
+    
     # Encode the request
     
     data = urlencode({
-        'q': location,
+        'q': smart_str(location),
         'output': "json",
         'oe': "utf8",
         'sensor': "false",
         'key': settings.GOOGLE_MAPS_API_KEY
     })
     
-    url = "http://maps.google.com/maps/geo?%s" % data
+    url = "%s?%s" % (getattr(settings, 'MACHETE_GEOCODER_URL', GEOCODER_URL), data)
     
     try:
-        response = urlopen(url)
+        response = urlopen(url, timeout=10)
         geo_content = simplejson.loads(response.read())
-        if geo_content['Status']['code'] == 200:
-            return geo_content
+        code = geo_content['Status']['code']
+    except (IOError, httplib.HTTPException, ValueError, KeyError, TypeError), e:
+        raise GeocodeError('Geocoding %r failed: %s' % (location, e))
+    
+    if code == 200:
+        return geo_content
+    elif code in NO_RESULT_CODES:
+        return False
+    
+    raise GeocodeError('Geocoding %r failed with status %s' % (location, code))
+
+# ---- BATCHES
+
+class RateLimiter(object):
+    
+    """
+    Thread safe token bucket, allowing `rate` calls per second on average
+    with bursts of up to `burst` calls
+    """
+    
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        
+        """
+        Block until a call is allowed
+        """
+        
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def batch_find_geo(locations, workers=4, rate=None, retries=3, backoff=0.5):
+    
+    """
+    Geocode lots of locations at once, e.g. during imports. Yields (location, geo information)
+    tuples as results come in, so not in the order given. Locations are deduplicated by normalized
+    address, cached results are yielded straight away and the rest are queried on up to `workers`
+    threads, limited to `rate` queries per second (defaults to the MACHETE_GEOCODE_RATE setting, or 10).
+    
+    Failed queries are retried up to `retries` times, waiting `backoff` seconds, doubled on each
+    retry (plus some jitter) in between. Locations that still fail are yielded with False.
+    """
+    
+    cache = get_geocode_cache()
+    limiter = RateLimiter(rate or getattr(settings, 'MACHETE_GEOCODE_RATE', 10))
+    pending = {}
+    
+    for location in locations:
+        key = normalize_location(location)
+        if key in pending:
+            pending[key].append(location)
+            continue
+        geo_content = cache.get(key) if key else False
+        if geo_content is not missing:
+            yield location, geo_content
         else:
-            raise
-    except:
-        return False
\ No newline at end of file
+            pending[key] = [location]
+    
+    if not pending:
+        return
+    
+    # Local lookups don't need a pool or rate limiting
+    
+    if get_gazetteer() is not None:
+        for key, locations in pending.items():
+            geo_content = find_geo(locations[0])
+            for location in locations:
+                yield location, geo_content
+        return
+    
+    queue = Queue()
+    results = Queue()
+    stopped = threading.Event()
+    
+    for key in pending:
+        queue.put(key)
+    
+    def work():
+        while not stopped.is_set():
+            try:
+                key = queue.get_nowait()
+            except Empty:
+                return
+            
+            geo_content = False
+            
+            # Every key taken off the queue has to put a result, or the generator waits forever
+            
+            try:
+                for attempt in range(retries + 1):
+                    if attempt:
+                        time.sleep(backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+                    limiter.acquire()
+                    try:
+                        geo_content = query_geo(pending[key][0])
+                    except GeocodeError:
+                        continue
+                    cache.set(key, geo_content)
+                    break
+            except Exception:
+                geo_content = False
+            
+            results.put((key, geo_content,))
+    
+    for i in range(min(workers, len(pending))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+    
+    try:
+        for i in range(len(pending)):
+            key, geo_content = results.get()
+            for location in pending[key]:
+                yield location, geo_content
+    finally:
+        # Let the workers wind down if the caller stops early
+        stopped.set()
+
+def batch_find_geo_point(locations, **kwargs):
+    
+    """
+    Same as batch_find_geo(), but yielding (location, find_geo_point() result) tuples
+    """
+    
+    for location, geo_content in batch_find_geo(locations, **kwargs):
+        yield location, get_geo_point(geo_content)
+
+# ---- CACHING
+
+normalize_re = re.compile(r'[\s.]+')
+comma_re = re.compile(r' ?, ?')
+
+def normalize_location(location):
+    
+    """
+    Normalize an address for use as a cache key: lowercased, with periods dropped
+    and whitespace collapsed, so '7719 N. McKenna Ave.,  Portland' and
+    '7719 n mckenna ave, portland' share a cache entry
+    """
+    
+    return comma_re.sub(',', normalize_re.sub(' ', smart_unicode(location).lower()).strip(' ,'))
+
+class GeocodeCache(object):
+    
+    """
+    Two-tier geocoding result cache: an in-process LRU cache in front of an optional SQLite
+    file, which keeps results across restarts and shares them between processes. Both
+    tiers honor the timeouts. Results are keyed by normalized address (see normalize_location()).
+    
+    `path`              Path of the SQLite file, None to cache in process only
+    `size`              Number of results kept in process
+    `timeout`           Seconds results are cached for
+    `negative_timeout`  Seconds "no such address" (False) results are cached for
+    """
+    
+    def __init__(self, path=None, size=1000, timeout=60 * 60 * 24 * 30, negative_timeout=60 * 60 * 24):
+        self.path = path
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.memory = LRUCache(size)
+        self._local = threading.local()
+        
+        if self.path:
+            self._get_connection().execute('CREATE TABLE IF NOT EXISTS machete_geocode (location TEXT PRIMARY KEY, result TEXT, expires REAL)')
+    
+    def get(self, location):
+        
+        """
+        Returns the cached result for a normalized address, or `missing`
+        """
+        
+        now = time.time()
+        cached = self.memory.get(location)
+        
+        if cached is not None:
+            expires, result = cached
+            if expires > now:
+                return result
+        
+        if not self.path:
+            return missing
+        
+        row = self._get_connection().execute('SELECT result, expires FROM machete_geocode WHERE location = ?', (location,)).fetchone()
+        
+        if row is None or row[1] <= now:
+            return missing
+        
+        result = simplejson.loads(row[0])
+        self.memory.set(location, (row[1], result,))
+        return result
+    
+    def set(self, location, result):
+        expires = time.time() + (self.timeout if result else self.negative_timeout)
+        self.memory.set(location, (expires, result,))
+        
+        if self.path:
+            connection = self._get_connection()
+            connection.execute('INSERT OR REPLACE INTO machete_geocode VALUES (?, ?, ?)', (location, simplejson.dumps(result), expires))
+            connection.commit()
+    
+    def purge(self):
+        
+        """
+        Delete expired results from the SQLite file
+        """
+        
+        if self.path:
+            connection = self._get_connection()
+            connection.execute('DELETE FROM machete_geocode WHERE expires <= ?', (time.time(),))
+            connection.commit()
+    
+    def clear(self):
+        self.memory.clear()
+        
+        if self.path:
+            connection = self._get_connection()
+            connection.execute('DELETE FROM machete_geocode')
+            connection.commit()
+    
+    def _get_connection(self):
+        
+        # SQLite connections can't be shared between threads
+        
+        connection = getattr(self._local, 'connection', None)
+        
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(os.path.expanduser(self.path), timeout=30)
+        
+        return connection
+
+# Shared cache for find_geo()
+
+geocode_cache = None
+
+def get_geocode_cache():
+    global geocode_cache
+    if geocode_cache is None:
+        geocode_cache = GeocodeCache(
+            getattr(settings, 'MACHETE_GEOCODE_CACHE_PATH', None),
+            getattr(settings, 'MACHETE_GEOCODE_CACHE_SIZE', 1000),
+            getattr(settings, 'MACHETE_GEOCODE_CACHE_TIMEOUT', 60 * 60 * 24 * 30),
+            getattr(settings, 'MACHETE_GEOCODE_NEGATIVE_TIMEOUT', 60 * 60 * 24),
+        )
+    return geocode_cache
+
+# Shared gazetteer for query_geo()
+
+gazetteer = None
+gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+    global gazetteer
+    path = getattr(settings, 'MACHETE_GEOCODE_GAZETTEER', None)
+    if not path:
+        return None
+    with gazetteer_lock:
+        if gazetteer is None or gazetteer.path != path:
+            from gazetteer import Gazetteer
+            gazetteer = Gazetteer(path)
+        return gazetteer
@@ -0,0 +1,94 @@
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.backends.util import truncate_name
+from models import STATUS_PUBLISHED
+
+"""
+Indexes for GlobalModel tables, matching the get_published_recent() query:
+    
+    ... WHERE status = 1 ORDER BY created DESC, id DESC
+
+A composite (status, created, id) index serves it on every backend, and on backends with
+partial indexes (PostgreSQL, SQLite) a smaller (created, id) index on published rows only
+does too. The id is included so the ordering is stable and pk-only queries, e.g.
+get_published_recent().values_list('pk', flat=True), can be answered from the index alone.
+
+A (modified, id) index serves the change feed, PublishedQuerySet.changes().
+
+Django can't declare these on an abstract model, so create them once per table with the
+'create_published_indexes' management command, or from a migration, e.g. with South:
+    
+    def forwards(self, orm):
+        create_published_indexes(Article)
+    
+    def backwards(self, orm):
+        drop_published_indexes(Article)
+
+"""
+
+COMPOSITE_INDEX_SQL = 'CREATE INDEX %(name)s ON %(table)s (%(status)s, %(created)s, %(pk)s)'
+PARTIAL_INDEX_SQL = 'CREATE INDEX %(name)s ON %(table)s (%(created)s, %(pk)s) WHERE %(status)s = %(published)d'
+CHANGES_INDEX_SQL = 'CREATE INDEX %(name)s ON %(table)s (%(modified)s, %(pk)s)'
+
+DROP_INDEX_SQL = {
+    'mysql': 'DROP INDEX %(name)s ON %(table)s',
+}
+
+def supports_partial_indexes(connection):
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 8, 0)
+    return connection.vendor == 'postgresql'
+
+def get_index_names(model, using=DEFAULT_DB_ALIAS):
+    
+    """
+    Returns the names of the composite index, the partial index (None if the
+    backend doesn't support them) and the change feed index for a GlobalModel subclass
+    """
+    
+    connection = connections[using]
+    table = model._meta.db_table
+    length = connection.ops.max_name_length()
+    partial = truncate_name('%s_published_created' % table, length) if supports_partial_indexes(connection) else None
+    return truncate_name('%s_status_created' % table, length), partial, truncate_name('%s_modified' % table, length)
+
+def get_published_index_sql(model, using=DEFAULT_DB_ALIAS, drop=False):
+    
+    """
+    Returns a list of the SQL statements creating (or dropping) the indexes for a GlobalModel subclass
+    """
+    
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    opts = model._meta
+    
+    params = {
+        'table': quote(opts.db_table),
+        'status': quote(opts.get_field('status').column),
+        'created': quote(opts.get_field('created').column),
+        'modified': quote(opts.get_field('modified').column),
+        'pk': quote(opts.pk.column),
+        'published': STATUS_PUBLISHED,
+    }
+    
+    statements = []
+    
+    for name, sql in zip(get_index_names(model, using), (COMPOSITE_INDEX_SQL, PARTIAL_INDEX_SQL, CHANGES_INDEX_SQL)):
+        if name is not None:
+            if drop:
+                sql = DROP_INDEX_SQL.get(connection.vendor, 'DROP INDEX %(name)s')
+            statements.append(sql % dict(params, name=quote(name)))
+    
+    return statements
+
+def create_published_indexes(model, using=DEFAULT_DB_ALIAS):
+    cursor = connections[using].cursor()
+    for sql in get_published_index_sql(model, using):
+        cursor.execute(sql)
+    transaction.commit_unless_managed(using=using)
+
+def drop_published_indexes(model, using=DEFAULT_DB_ALIAS):
+    cursor = connections[using].cursor()
+    for sql in get_published_index_sql(model, using, drop=True):
+        cursor.execute(sql)
+    transaction.commit_unless_managed(using=using)
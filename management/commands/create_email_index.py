@@ -0,0 +1,31 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+from ...auth.indexes import create_email_index, get_email_index_sql
+
+class Command(BaseCommand):
+    
+    """
+    Create the case-insensitive auth_user.email index ModelBackendFlexible's email lookups use
+    """
+    
+    help = 'Creates a case-insensitive index on auth_user.email, for logging in by email'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to create the index in, defaults to the "default" database'),
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Print the SQL instead of running it'),
+    )
+    
+    def handle(self, *args, **options):
+        
+        try:
+            if options['sql']:
+                self.stdout.write('%s;\n' % get_email_index_sql(options['database']))
+                return
+            create_email_index(options['database'])
+        except (ValueError, DatabaseError), e:
+            raise CommandError(str(e))
+        
+        self.stdout.write('Created the email index\n')
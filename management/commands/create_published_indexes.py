@@ -0,0 +1,46 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+from django.db.models import get_model, get_models
+from ...indexes import create_published_indexes, get_published_index_sql
+from ...models import GlobalModel
+
+class Command(BaseCommand):
+    
+    """
+    Create the indexes get_published_recent() and changes() use on GlobalModel tables
+    """
+    
+    args = '[app_label.ModelName ...]'
+    help = 'Creates (status, created), published-only and (modified) indexes on the given GlobalModel tables, or all of them'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to create the indexes in, defaults to the "default" database'),
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Print the SQL instead of running it'),
+    )
+    
+    def handle(self, *args, **options):
+        
+        if args:
+            models = []
+            for label in args:
+                model = get_model(*label.split('.', 1)) if '.' in label else None
+                if model is None or not issubclass(model, GlobalModel):
+                    raise CommandError('%s is not a GlobalModel' % label)
+                models.append(model)
+        else:
+            models = [model for model in get_models() if issubclass(model, GlobalModel)]
+        
+        for model in models:
+            try:
+                if options['sql']:
+                    for sql in get_published_index_sql(model, options['database']):
+                        self.stdout.write('%s;\n' % sql)
+                    continue
+                create_published_indexes(model, options['database'])
+            except DatabaseError, e:
+                raise CommandError('%s: %s' % (model._meta.db_table, e))
+            
+            self.stdout.write('Created the indexes for %s\n' % model._meta.db_table)
@@ -0,0 +1,45 @@
+import time
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ...twitter import TwitterRefresher
+
+class Command(BaseCommand):
+    
+    """
+    Keep the timelines listed in MACHETE_TWITTER_TIMELINES warm in the cache
+    """
+    
+    help = 'Keeps the Twitter timelines in MACHETE_TWITTER_TIMELINES fresh in the cache'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Refresh every timeline once and exit, e.g. when running from cron'),
+        make_option('--interval', type='int', dest='interval', default=None,
+            help='Seconds between refreshes, defaults to MACHETE_TWITTER_REFRESH_INTERVAL or 60'),
+        make_option('--batch-size', type='int', dest='batch_size', default=20,
+            help='Number of timelines fetched concurrently per batch'),
+    )
+    
+    def handle(self, *args, **options):
+        
+        timelines = getattr(settings, 'MACHETE_TWITTER_TIMELINES', ())
+        
+        if not timelines:
+            raise CommandError('No timelines to refresh, set MACHETE_TWITTER_TIMELINES')
+        
+        interval = options['interval'] or getattr(settings, 'MACHETE_TWITTER_REFRESH_INTERVAL', 60)
+        refresher = TwitterRefresher(timelines, interval=interval, batch_size=options['batch_size'])
+        
+        if options['once']:
+            failed = refresher.refresh()
+            self.stdout.write('Refreshed %d timelines, %d failed\n' % (len(refresher.timelines), failed))
+            return
+        
+        refresher.start()
+        
+        try:
+            while refresher.is_alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            refresher.stop()
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+"""
+Bounded in-process memoization, for functions (mostly template filters) that
+get called with the same arguments over and over
+"""
+
+class LRUCache(object):
+    
+    """
+    A size-capped, thread safe dict that throws out the least recently used entries
+    once it's full, and keeps count of its hits and misses.
+    
+    `size`
+    The maximum number of entries to hold. A size of 0 disables the cache.
+    """
+    
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        
+        """
+        Return the value for `key`, marking it as most recently used, or `default` if it's not cached
+        """
+        
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+    
+    def set(self, key, value):
+        if not self.size:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+    
+    def stats(self):
+        
+        """
+        Returns a dict with the hit/miss counts, hit rate and current size
+        """
+        
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+            'size': len(self._data),
+            'max_size': self.size,
+        }
+
+# Marker for cache misses, since None is a perfectly good result
+
+missing = object()
+
+def memoize(cache):
+    
+    """
+    Decorator memoizing a function's results in `cache` (an LRUCache), keyed on the
+    function name and its arguments. Lists are cached as is but handed back as copies,
+    so callers can't change the cached version.
+    
+    Example:
+        
+        filter_cache = LRUCache(500)
+        
+        @memoize(filter_cache)
+        def expensive(value, arg):
+            ...
+    
+    """
+    
+    def decorator(func):
+        
+        @wraps(func)
+        def wrapper(*args):
+            
+            if not cache.size:
+                return func(*args)
+            
+            key = (func.__name__,) + args
+            
+            try:
+                result = cache.get(key, missing)
+            except TypeError:
+                # Unhashable arguments
+                return func(*args)
+            
+            if result is missing:
+                result = func(*args)
+                cache.set(key, result)
+            
+            if isinstance(result, list):
+                return list(result)
+            return result
+        
+        # Let Django's template filter argument checking see the real signature
+        
+        wrapper._decorated_function = getattr(func, '_decorated_function', func)
+        
+        return wrapper
+    
+    return decorator
@@ -1,7 +1,22 @@
-from django.db import models
+import threading
+import uuid
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.hashcompat import md5_constructor
 
 """
 Global model and queryset definitions. Add 'status', 'created' and 'modified' fields
+
+Settings (all optional):
+    
+    MACHETE_QUERYSET_CACHE_TIMEOUT  Seconds PublishedQuerySet.cached() results are kept for,
+                                    0 to turn result caching off (default 300)
+
 """
 
 # Status choices
@@ -22,8 +37,336 @@ properly
 """
 
 class PublishedQuerySet(models.query.QuerySet):
+    
+    # Result caching options set by cached(), a (timeout, pks) tuple
+    
+    _cache_options = None
+    
     def get_published(self):
         return self.filter(status=STATUS_PUBLISHED)
+    
+    def get_published_recent(self):
+        
+        """
+        Published items, newest first, ordered to match the indexes in indexes.py
+        """
+        
+        return self.get_published().order_by('-created', '-pk')
+    
+    def update(self, **kwargs):
+        
+        """
+        Same as QuerySet.update(), invalidating cached() results for the model
+        """
+        
+        updated = super(PublishedQuerySet, self).update(**kwargs)
+        invalidate_cached(self.model)
+        return updated
+    
+    def touch(self, **kwargs):
+        
+        """
+        Same as update(), but stamping 'modified' like save() does (unless it's being set),
+        so the rows show up in changes()
+        """
+        
+        if 'modified' in [field.name for field in self.model._meta.fields]:
+            kwargs.setdefault('modified', datetime.now())
+        return self.update(**kwargs)
+    
+    # ---- RESULT CACHING
+    
+    def cached(self, timeout=None, pks=False):
+        
+        """
+        Opt this QuerySet in to result caching, e.g. for listings every page shows:
+            
+            Article.objects.get_published_recent().cached()[:5]
+        
+        Results are cached under a key made of the generated SQL and the model's cache generation,
+        which moves on whenever one of its rows is saved or deleted, or through update(), touch(),
+        bulk_insert(), bulk_update() and upsert(), so admin actions invalidate them too. Only the
+        model's own table (and its parents') are tracked, so don't cache QuerySets whose results
+        depend on other models, e.g. through select_related(). Writes inside a transaction invalidate
+        before they're committed, so a concurrent request can cache the old results until `timeout`.
+        
+        `timeout`
+        Seconds results are kept for, defaults to the MACHETE_QUERYSET_CACHE_TIMEOUT setting (or 300)
+        
+        `pks`
+        Cache the list of primary keys instead of the instances, which are then fetched by
+        primary key. Keeps cache entries small and still skips the expensive part of the query.
+        """
+        
+        if timeout is None:
+            timeout = getattr(settings, 'MACHETE_QUERYSET_CACHE_TIMEOUT', 300)
+        return self._clone(_cache_options=(timeout, pks,))
+    
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_cache_options', self._cache_options)
+        return super(PublishedQuerySet, self)._clone(*args, **kwargs)
+    
+    # values(), values_list() and dates() return QuerySet classes that don't
+    # check the caching options, so refuse rather than silently not cache
+    
+    def values(self, *fields):
+        self._check_uncached('values')
+        return super(PublishedQuerySet, self).values(*fields)
+    
+    def values_list(self, *fields, **kwargs):
+        self._check_uncached('values_list')
+        return super(PublishedQuerySet, self).values_list(*fields, **kwargs)
+    
+    def dates(self, *args, **kwargs):
+        self._check_uncached('dates')
+        return super(PublishedQuerySet, self).dates(*args, **kwargs)
+    
+    def _check_uncached(self, method):
+        if self._cache_options:
+            raise ValueError("%s() results can't be cached, call it before cached() or use cached(pks=True) instead" % method)
+    
+    def delete(self):
+        
+        # Delete what's in the database, not whatever rows cached() results hold
+        
+        if self._cache_options:
+            return self._clone(_cache_options=None).delete()
+        return super(PublishedQuerySet, self).delete()
+    
+    def _as_sql(self, connection):
+        
+        # Used as a subquery, e.g. filter(pk__in=queryset), which goes through values()
+        
+        if self._cache_options:
+            return self._clone(_cache_options=None)._as_sql(connection)
+        return super(PublishedQuerySet, self)._as_sql(connection)
+    
+    def iterator(self):
+        if not self._cache_options or not self._cache_options[0]:
+            return super(PublishedQuerySet, self).iterator()
+        return iter(self._get_cached_results())
+    
+    def _get_cached_results(self):
+        timeout, pks = self._cache_options
+        
+        try:
+            sql, params = self.query.get_compiler(using=self.db).as_sql()
+        except EmptyResultSet:
+            return []
+        
+        key = 'machete.queryset.%s.%s' % (get_cache_generation(self.model), md5_constructor(repr((self.db, pks, sql, params,))).hexdigest())
+        results = cache.get(key)
+        count_cached(self.model, results is not None)
+        
+        if results is None:
+            results = list(super(PublishedQuerySet, self).iterator())
+            if pks:
+                cache.set(key, [obj.pk for obj in results], timeout)
+            else:
+                cache.set(key, results, timeout)
+        elif pks and results:
+            
+            # Keep select_related(), only() and the like, but not the slice
+            
+            queryset = self._clone(_cache_options=None)
+            queryset.query.clear_limits()
+            objs = dict((obj.pk, obj) for obj in queryset.filter(pk__in=results))
+            results = [objs[pk] for pk in results if pk in objs]
+        
+        return results
+    
+    def changes(self, since=None, until=None, batch_size=1000):
+        
+        """
+        Iterate over the items modified after the `since` watermark in (modified, pk) order,
+        e.g. to feed a search indexer incrementally. Status changes count as modifications,
+        since save(), touch() and the admin status actions stamp 'modified'; plain
+        update() calls and deletions aren't seen.
+        
+        `since`
+        A (modified, pk) tuple, typically those of the last item the previous run got through,
+        see get_watermark(). None starts from the beginning.
+        
+        `until`
+        Optional datetime to stop at (exclusive), e.g. a few seconds ago, so rows from
+        transactions that haven't committed yet aren't skipped over for good.
+        
+        `batch_size`
+        Rows fetched per query. Each batch picks up after the last row of the previous one
+        instead of using an OFFSET, so only a batch is held in memory and every query costs
+        the same. Run create_published_indexes for the (modified, id) index this walks.
+        """
+        
+        # Always walk the table itself, never cached() results
+        
+        queryset = self._clone(_cache_options=None).order_by('modified', 'pk')
+        
+        if until is not None:
+            queryset = queryset.filter(modified__lt=until)
+        
+        while True:
+            batch = queryset
+            
+            if since is not None:
+                batch = batch.filter(get_watermark_filter(since))
+            
+            objs = list(batch[:batch_size])
+            
+            for obj in objs:
+                yield obj
+            
+            if len(objs) < batch_size:
+                return
+            
+            since = get_watermark(objs[-1])
+    
+    # ---- BULK HELPERS
+    
+    def bulk_insert(self, objs, batch_size=500):
+        
+        """
+        Insert a list of unsaved model instances with multi-row INSERT statements, `batch_size`
+        rows at a time, stamping 'created' (unless it's set) and 'modified' and defaulting 'status'.
+        Like Django's bulk_create(), no signals are sent and the instances' primary keys aren't set.
+        Returns the number of rows inserted.
+        """
+        
+        if not objs:
+            return 0
+        
+        opts = self.model._meta
+        
+        if opts.parents:
+            raise ValueError("bulk_insert() can't insert into multi-table inheritance models")
+        
+        connection = connections[self.db]
+        fields = [field for field in opts.local_fields if not isinstance(field, models.AutoField)]
+        now = datetime.now()
+        
+        for obj in objs:
+            stamp(obj, now, add=True)
+        
+        sql = 'INSERT INTO %s (%s) VALUES ' % (connection.ops.quote_name(opts.db_table), ', '.join(connection.ops.quote_name(field.column) for field in fields))
+        placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+        batch_size = get_batch_size(connection, batch_size, len(fields))
+        cursor = connection.cursor()
+        rows = []
+        
+        for obj in objs:
+            rows.append([field.get_db_prep_save(getattr(obj, field.attname) if field.name in ('created', 'modified') else field.pre_save(obj, True), connection=connection) for field in fields])
+        
+        if connection.vendor not in MULTI_ROW_INSERT_VENDORS:
+            cursor.executemany(sql + placeholders, rows)
+        else:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                cursor.execute(sql + ', '.join([placeholders] * len(batch)), [value for row in batch for value in row])
+        
+        transaction.commit_unless_managed(using=self.db)
+        invalidate_cached(self.model)
+        return len(objs)
+    
+    def bulk_update(self, objs, fields, batch_size=500):
+        
+        """
+        Save `fields` (a list of field names) of a list of saved model instances, with one
+        'UPDATE ... SET field = CASE pk WHEN ... END' statement per `batch_size` instances,
+        stamping 'modified'. No signals are sent. Returns the number of rows updated.
+        """
+        
+        if not objs:
+            return 0
+        
+        opts = self.model._meta
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        fields = [opts.get_field(name) for name in fields if name != 'modified']
+        now = datetime.now()
+        
+        for obj in objs:
+            stamp(obj, now)
+        
+        if 'modified' in [field.name for field in opts.fields]:
+            fields.append(opts.get_field('modified'))
+        
+        pk = quote(opts.pk.column)
+        batch_size = get_batch_size(connection, batch_size, 2 * len(fields) + 1)
+        cursor = connection.cursor()
+        updated = 0
+        
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            assignments = []
+            params = []
+            
+            for field in fields:
+                
+                # PostgreSQL can't tell the type of a CASE made of placeholders only
+                
+                value = 'CAST(%%s AS %s)' % field.db_type(connection) if connection.vendor == 'postgresql' else '%s'
+                assignments.append('%s = CASE %s %s END' % (quote(field.column), pk, ' '.join(['WHEN %%s THEN %s' % value] * len(batch))))
+                
+                for obj in batch:
+                    params.extend([obj.pk, field.get_db_prep_save(getattr(obj, field.attname), connection=connection)])
+            
+            params.extend(obj.pk for obj in batch)
+            cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (quote(opts.db_table), ', '.join(assignments), pk, ', '.join(['%s'] * len(batch))), params)
+            updated += cursor.rowcount
+        
+        transaction.commit_unless_managed(using=self.db)
+        invalidate_cached(self.model)
+        return updated
+    
+    def upsert(self, objs, key, fields=None, batch_size=500):
+        
+        """
+        Insert or update a list of model instances, matching them to existing rows by `key`,
+        a field name or a list of them (e.g. ['source', 'external_id']). Matched instances get
+        the existing row's primary key and have `fields` updated with bulk_update(); the rest
+        are inserted with bulk_insert(). Returns an (inserted, updated) tuple.
+        
+        `fields` defaults to every field but 'status' and 'created', so re-importing a row
+        doesn't publish a draft or reset its creation date; name them to update them too.
+        
+        Existing rows are looked up before anything is inserted, so concurrent upserts of the
+        same new key can both insert it unless `key` has a unique constraint.
+        """
+        
+        keys = [key] if isinstance(key, basestring) else list(key)
+        opts = self.model._meta
+        
+        # Compare by attname, so a ForeignKey key is matched by its id on both sides
+        
+        attnames = [opts.get_field(name).attname for name in keys]
+        
+        if fields is None:
+            fields = [field.name for field in opts.local_fields if not field.primary_key and field.name not in ['created', 'status'] + keys]
+        
+        existing = {}
+        manager = self.model._default_manager.db_manager(self.db)
+        lookup_size = get_batch_size(connections[self.db], batch_size, len(keys))
+        
+        for start in range(0, len(objs), lookup_size):
+            batch = objs[start:start + lookup_size]
+            if len(keys) == 1:
+                lookup = Q(**{'%s__in' % keys[0]: [getattr(obj, attnames[0]) for obj in batch]})
+            else:
+                lookup = reduce(lambda a, b: a | b, [Q(**dict((name, getattr(obj, attname)) for name, attname in zip(keys, attnames))) for obj in batch])
+            for row in manager.filter(lookup).values_list('pk', *keys):
+                existing[tuple(row[1:])] = row[0]
+        
+        inserts = []
+        updates = []
+        
+        for obj in objs:
+            pk = existing.get(tuple(getattr(obj, attname) for attname in attnames))
+            if pk is None:
+                inserts.append(obj)
+            else:
+                obj.pk = pk
+                updates.append(obj)
+        
+        return self.bulk_insert(inserts, batch_size), self.bulk_update(updates, fields, batch_size)
 
 class PublishedManager(models.Manager):
     def get_query_set(self):
@@ -31,10 +374,181 @@ class PublishedManager(models.Manager):
     
     def get_published(self):
         return self.get_query_set().get_published()
+    
+    def get_published_recent(self):
+        return self.get_query_set().get_published_recent()
+    
+    def cached(self, *args, **kwargs):
+        return self.get_query_set().cached(*args, **kwargs)
+    
+    def changes(self, *args, **kwargs):
+        return self.get_query_set().changes(*args, **kwargs)
+    
+    def touch(self, *args, **kwargs):
+        return self.get_query_set().touch(*args, **kwargs)
+    
+    def bulk_insert(self, *args, **kwargs):
+        return self.get_query_set().bulk_insert(*args, **kwargs)
+    
+    def bulk_update(self, *args, **kwargs):
+        return self.get_query_set().bulk_update(*args, **kwargs)
+    
+    def upsert(self, *args, **kwargs):
+        return self.get_query_set().upsert(*args, **kwargs)
+
+# ---- RESULT CACHING UTILITY
+
+cache_stats = {}
+cache_stats_lock = threading.Lock()
+
+def get_generation_key(model):
+    return 'machete.queryset.generation.%s' % model._meta.db_table
+
+def get_cache_generation(model):
+    
+    """
+    Returns the cache generation of a model's table, starting one if there's none
+    """
+    
+    key = get_generation_key(model)
+    generation = cache.get(key)
+    
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, 60 * 60 * 24 * 30)
+        generation = cache.get(key)
+    
+    return generation
+
+def invalidate_cached(model):
+    
+    """
+    Move a model's cache generation (and its parents', which hold part of its rows) on,
+    so every cached() result for it is ignored from then on. A fresh random generation
+    is used rather than a counter, so evicted generations never come back around.
+    """
+    
+    for model in [model] + list(model._meta.get_parent_list()):
+        cache.set(get_generation_key(model), uuid.uuid4().hex, 60 * 60 * 24 * 30)
+        count_cached(model, None)
+
+def count_cached(model, hit):
+    with cache_stats_lock:
+        stats = cache_stats.setdefault(model._meta.db_table, {'hits': 0, 'misses': 0, 'invalidations': 0})
+        stats['hits' if hit else 'misses' if hit is not None else 'invalidations'] += 1
+
+def get_cache_stats(model=None):
+    
+    """
+    Returns a dict with the hit/miss counts, hit rate and number of invalidations of cached()
+    QuerySets for a model, or for every model put together, in this process
+    """
+    
+    with cache_stats_lock:
+        if model is not None:
+            counts = [cache_stats.get(model._meta.db_table, {})]
+        else:
+            counts = cache_stats.values()
+        hits, misses, invalidations = [sum(stats.get(name, 0) for stats in counts) for name in ('hits', 'misses', 'invalidations')]
+    
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / total if total else 0.0,
+        'invalidations': invalidations,
+    }
+
+def reset_cache_stats():
+    with cache_stats_lock:
+        cache_stats.clear()
+
+def invalidate_cached_receiver(sender, **kwargs):
+    if issubclass(sender, GlobalModel):
+        invalidate_cached(sender)
+
+post_save.connect(invalidate_cached_receiver, dispatch_uid='machete.models.invalidate_cached')
+post_delete.connect(invalidate_cached_receiver, dispatch_uid='machete.models.invalidate_cached')
+
+# ---- CHANGE FEED UTILITY
+
+def get_watermark(obj):
+    
+    """
+    Returns the (modified, pk) watermark to pass to changes() to pick up after `obj`
+    """
+    
+    return (obj.modified, obj.pk,)
+
+def get_watermark_filter(watermark):
+    
+    """
+    Returns the filter selecting items after a watermark:
+    modified >= x AND (modified > x OR pk > y). The leading range lets the
+    database seek straight to the watermark in the (modified, id) index,
+    instead of scanning the index up to it.
+    """
+    
+    modified, pk = watermark
+    return Q(modified__gte=modified) & (Q(modified__gt=modified) | Q(pk__gt=pk))
+
+def dump_watermark(watermark):
+    
+    """
+    Turn a watermark into a string for storing between runs, e.g. '2012-01-31T09:30:00.000012,42'
+    """
+    
+    modified, pk = watermark
+    return '%s,%s' % (modified.strftime('%Y-%m-%dT%H:%M:%S.%f'), pk)
+
+def load_watermark(value):
+    
+    """
+    Turn a dump_watermark() string back into a watermark, raising ValueError if it's not one
+    """
+    
+    modified, pk = value.split(',', 1)
+    return (datetime.strptime(modified, '%Y-%m-%dT%H:%M:%S.%f'), pk,)
+
+# ---- BULK HELPER UTILITY
+
+# Backends taking INSERT ... VALUES (...), (...), the rest get one statement per row
+
+MULTI_ROW_INSERT_VENDORS = ('postgresql', 'mysql', 'sqlite',)
+
+def stamp(obj, now, add=False):
+    
+    """
+    Set 'created' (if it's not set, when adding), 'modified' and a missing 'status' on a model instance
+    """
+    
+    if add and getattr(obj, 'created', False) is None:
+        obj.created = now
+    if hasattr(obj, 'modified'):
+        obj.modified = now
+    if getattr(obj, 'status', False) is None:
+        obj.status = STATUS_PUBLISHED
+
+def get_batch_size(connection, batch_size, params_per_row):
+    
+    """
+    Cap the batch size to what the backend takes in a single statement
+    (SQLite builds older than 3.32 allow 999 parameters)
+    """
+    
+    if connection.vendor == 'sqlite':
+        return max(1, min(batch_size, 999 // params_per_row))
+    return batch_size
 
 # Global field model
 
 class GlobalModel(models.Model):
+    
+    """
+    Abstract base model adding 'status', 'created' and 'modified'. Like any Django model,
+    'modified' is only stamped by save(); use objects.touch() instead of update() for bulk
+    changes that should stamp it too.
+    """
+    
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
     status = models.SmallIntegerField(max_length=max([len(str(STATUS_DRAFT)), len(str(STATUS_PUBLISHED))]), db_index=True, choices=STATUS_OPTIONS, default=STATUS_PUBLISHED)
@@ -1,12 +1,167 @@
+import base64
 import math
-from django.core.paginator import Paginator, Page
+import re
+import simplejson
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator, Page, InvalidPage, EmptyPage, PageNotAnInteger
+from django.db import connections
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import smart_str, smart_unicode
+from django.utils.hashcompat import md5_constructor
 
 """
 Pagination classes for windowed/ranged pagination
 """
 
+# ---- COUNT STRATEGIES
+
+class ExactCount(object):
+    
+    """
+    Default count strategy: a plain SELECT COUNT(*), or len() for non-QuerySet lists,
+    same as Django's Paginator
+    """
+    
+    def get_count(self, object_list):
+        try:
+            return object_list.count()
+        except (AttributeError, TypeError):
+            return len(object_list)
+
+class CachedCount(ExactCount):
+    
+    """
+    Count strategy that caches the exact count, keyed by the QuerySet's SQL and parameters,
+    for `timeout` seconds. Good for listings where a slightly stale page count is fine.
+    """
+    
+    def __init__(self, timeout=300, key_prefix='machete.paginator.count'):
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+    
+    def get_count(self, object_list):
+        
+        try:
+            sql, params = object_list.query.get_compiler(object_list.db).as_sql()
+        except AttributeError:
+            return len(object_list)
+        except EmptyResultSet:
+            return 0
+        
+        key = '%s.%s' % (self.key_prefix, md5_constructor(smart_str(repr((object_list.db, sql, params)))).hexdigest())
+        count = cache.get(key)
+        
+        if count is None:
+            count = super(CachedCount, self).get_count(object_list)
+            cache.set(key, count, self.timeout)
+        
+        return count
+
+class ApproximateCount(ExactCount):
+    
+    """
+    Count strategy that asks the database query planner for its row estimate instead of
+    counting (supported on PostgreSQL and MySQL). Falls back to an exact count when the
+    backend can't estimate, or when the estimate is under `threshold` rows and counting is cheap anyway.
+    """
+    
+    rows_re = re.compile(r'rows=(\d+)')
+    
+    def __init__(self, threshold=10000):
+        self.threshold = threshold
+    
+    def get_count(self, object_list):
+        estimate = self.get_estimate(object_list)
+        if estimate is None or estimate < self.threshold:
+            return super(ApproximateCount, self).get_count(object_list)
+        return estimate
+    
+    def get_estimate(self, object_list):
+        
+        """
+        Returns the planner's row estimate for the QuerySet, or None if it can't be had
+        """
+        
+        try:
+            sql, params = object_list.query.get_compiler(object_list.db).as_sql()
+            connection = connections[object_list.db]
+        except AttributeError:
+            return None
+        except EmptyResultSet:
+            return 0
+        
+        if connection.vendor not in ('postgresql', 'mysql'):
+            return None
+        
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN %s' % sql, params)
+        row = cursor.fetchone()
+        
+        if connection.vendor == 'postgresql':
+            
+            # First plan line looks like: Seq Scan on app_model  (cost=0.00..431.00 rows=21000 width=4)
+            
+            match = self.rows_re.search(row[0])
+            return int(match.group(1)) if match else None
+        
+        # MySQL returns a 'rows' column for each table in the plan
+        
+        columns = [column[0] for column in cursor.description]
+        if not row or row[columns.index('rows')] is None:
+            return None
+        return int(row[columns.index('rows')])
+
+class NoCount(object):
+    
+    """
+    Count strategy that never counts. Pages find out whether there's a next page by fetching
+    one extra row, and `page_range` ends with None to indicate "more" instead of the last page.
+    """
+    
+    def get_count(self, object_list):
+        return None
+
+# ---- PAGINATION
+
 class WindowPaginator(Paginator):
     
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, key=None, count_strategy=None, lookahead=False):
+        
+        """
+        WindowPaginator constructor
+        
+        `key`
+        Optional field name to paginate by using keyset (a.k.a. "seek") pagination, e.g. 'pk' or '-created'.
+        A leading '-' sorts descending. Unless the key is the primary key itself, the primary key is added
+        as a tie-breaker so the ordering is unique. The object list must be a QuerySet, and the key should
+        be indexed (ideally together with the primary key) and never NULL.
+        
+        With a key set, pages returned by page() and cursor_page() carry `next_cursor` and `previous_cursor`
+        strings, and cursor_page() fetches a page with a "WHERE key > last seen value" query instead of an
+        OFFSET, so it costs the same no matter how deep you page.
+        
+        `count_strategy`
+        How the total object count is found, see ExactCount (default), CachedCount,
+        ApproximateCount and NoCount above.
+        
+        `lookahead`
+        If True, page() fetches per_page + orphans + 1 rows in a single query and works out
+        has_next() and orphans from that, so a page renders with one database round trip.
+        The count is deferred until something actually needs it (`num_pages`, `page_range`)
+        and is derived from the rows fetched when the last page is requested. This is always
+        the behavior with NoCount.
+        """
+        
+        super(WindowPaginator, self).__init__(object_list, per_page, orphans, allow_empty_first_page)
+        self.key = key
+        self.count_strategy = count_strategy or ExactCount()
+        self.lookahead = lookahead
+        
+        if self.key is not None:
+            self.object_list = self.object_list.order_by(*self._get_key_ordering())
+    
     def page(self, number, window=None):
         
         """
@@ -17,13 +172,198 @@ class WindowPaginator(Paginator):
         
         number = self.validate_number(number)
         bottom = (number - 1) * self.per_page
+        
+        if self.lookahead or self.count is None:
+            return self._lookahead_page(number, bottom, window)
+        
         top = bottom + self.per_page
         if top + self.orphans >= self.count:
             top = self.count
         return WindowPage(self.object_list[bottom:top], number, self, window=window)
+    
+    def _lookahead_page(self, number, bottom, window=None):
+        
+        """
+        Fetch the page in a single query, grabbing one more row than the page could hold
+        (orphans included) to find out if there's a next page instead of counting first
+        """
+        
+        object_list = list(self.object_list[bottom:bottom + self.per_page + self.orphans + 1])
+        has_next = len(object_list) > self.per_page + self.orphans
+        
+        if has_next:
+            object_list = object_list[:self.per_page]
+        elif number > 1 and len(object_list) <= self.orphans:
+            # Nothing left, or few enough rows that the previous page took them in as orphans
+            raise EmptyPage('That page contains no results')
+        elif not object_list and not self.allow_empty_first_page:
+            raise EmptyPage('That page contains no results')
+        else:
+            # Last page, so the count comes for free
+            if self._count is None:
+                self._count = bottom + len(object_list)
+        
+        return WindowPage(object_list, number, self, window=window, has_next=has_next)
+    
+    def validate_number(self, number):
+        
+        """
+        Same as Paginator.validate_number, but skipping the last page check when the
+        count is being deferred or there's no count at all
+        """
+        
+        if self.lookahead or self.count is None:
+            try:
+                number = int(number)
+            except ValueError:
+                raise PageNotAnInteger('That page number is not an integer')
+            if number < 1:
+                raise EmptyPage('That page number is less than 1')
+            return number
+        return super(WindowPaginator, self).validate_number(number)
+    
+    def cursor_page(self, cursor=None, window=None):
+        
+        """
+        Returns a WindowPage object for the given cursor, as generated by a previous
+        page's `next_cursor` or `previous_cursor`. Returns the first page if no cursor is passed.
+        
+        The page number travels along in the cursor, so `page_range` can still be built
+        as long as the visitor got here by following cursors from the first page.
+        """
+        
+        if self.key is None:
+            raise ValueError('cursor_page() requires the paginator to be created with a `key`')
+        
+        queryset = self.object_list
+        number = 1
+        previous = False
+        
+        if cursor:
+            previous, number, values = self.decode_cursor(cursor)
+            queryset = queryset.filter(self._get_key_filter(values, previous))
+        
+        if previous:
+            
+            # Walk backwards from the cursor, then flip the results back into key order
+            
+            object_list = list(queryset.reverse()[:self.per_page + 1])
+            has_previous = len(object_list) > self.per_page
+            object_list = object_list[:self.per_page]
+            object_list.reverse()
+            has_next = True
+            if not has_previous:
+                number = 1
+        else:
+            
+            # Fetch one more than the page could hold (orphans included) to find out if there's a next page
+            
+            object_list = list(queryset[:self.per_page + self.orphans + 1])
+            has_next = len(object_list) > self.per_page + self.orphans
+            if has_next:
+                object_list = object_list[:self.per_page]
+            has_previous = number > 1
+        
+        if not object_list and (cursor or not self.allow_empty_first_page):
+            raise EmptyPage('That page contains no results')
+        
+        return WindowPage(object_list, number, self, window=window, has_next=has_next, has_previous=has_previous)
+    
+    def encode_cursor(self, item, number, previous=False):
+        
+        """
+        Build an opaque, URL-safe cursor pointing at the page `number` that comes
+        after `item` (or before it, if `previous` is True)
+        """
+        
+        values = [smart_unicode(getattr(item, name)) for name, descending in self._get_key_fields()]
+        data = simplejson.dumps([int(previous), number, values], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data).rstrip('=')
+    
+    def decode_cursor(self, cursor):
+        
+        """
+        Decode a cursor generated by encode_cursor() into a (previous, number, values) tuple,
+        raising InvalidPage if it has been tampered with
+        """
+        
+        fields = self._get_key_fields()
+        model = self.object_list.model
+        
+        try:
+            cursor = smart_str(cursor)
+            previous, number, values = simplejson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            if len(values) != len(fields) or int(number) < 1:
+                raise ValueError()
+            values = [self._get_key_field(model, name).to_python(value) for (name, descending), value in zip(fields, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise InvalidPage('That cursor is invalid')
+        
+        return bool(previous), int(number), values
+    
+    def _get_count(self):
+        if self._count is None:
+            self._count = self.count_strategy.get_count(self.object_list)
+        return self._count
+    
+    count = property(_get_count)
+    
+    def _get_num_pages(self):
+        if self.count is None:
+            return None
+        return super(WindowPaginator, self)._get_num_pages()
+    
+    num_pages = property(_get_num_pages)
+    
+    def _get_key_fields(self):
+        
+        """
+        Returns a list of (field name, descending) tuples for the key, with the primary key
+        added as a tie-breaker
+        """
+        
+        descending = self.key.startswith('-')
+        name = self.key.lstrip('-')
+        fields = [(name, descending)]
+        
+        if name not in ('pk', self.object_list.model._meta.pk.name):
+            fields.append(('pk', descending))
+        
+        return fields
+    
+    def _get_key_field(self, model, name):
+        if name == 'pk':
+            return model._meta.pk
+        return model._meta.get_field(name)
+    
+    def _get_key_ordering(self):
+        return ['%s%s' % ('-' if descending else '', name) for name, descending in self._get_key_fields()]
+    
+    def _get_key_filter(self, values, previous=False):
+        
+        """
+        Build the "row comparison" filter selecting everything after (or before) the
+        given key values, e.g. for '-created': created <= x AND (created < x OR (created = x AND pk < y)).
+        The leading range on the first field lets the database seek straight to the cursor
+        in a (created, id) index, instead of scanning the index up to it.
+        """
+        
+        fields = self._get_key_fields()
+        key_filter = None
+        
+        for i, (name, descending) in enumerate(fields):
+            kwargs = dict((fields[j][0], values[j]) for j in range(i))
+            kwargs['%s__%s' % (name, 'lt' if descending != previous else 'gt')] = values[i]
+            key_filter = Q(**kwargs) if key_filter is None else key_filter | Q(**kwargs)
+        
+        if len(fields) > 1:
+            name, descending = fields[0]
+            key_filter = Q(**{'%s__%s' % (name, 'lte' if descending != previous else 'gte'): values[0]}) & key_filter
+        
+        return key_filter
 
 class WindowPage(Page):
-    def __init__(self, object_list, number, paginator, window=None):
+    def __init__(self, object_list, number, paginator, window=None, has_next=None, has_previous=None):
         
         """
         WindowPage object constructor
@@ -32,13 +372,55 @@ class WindowPage(Page):
         A number indicating how many page links you want to display in between the first and last pages.
         Example: a value of '5' with a total of 30 pages, on page 14 would yield a page range of:
         [1, None, 12, 13, 14, 15, 16, None, 30]
+        
+        `has_next`, `has_previous`
+        Set by WindowPaginator.cursor_page(), which already knows whether there are more
+        pages without having to count the whole object list
         """
         
         super(WindowPage, self).__init__(object_list, number, paginator)
         self.window = window
+        self._has_next = has_next
+        self._has_previous = has_previous
+    
+    def has_next(self):
+        if self._has_next is not None:
+            return self._has_next
+        return super(WindowPage, self).has_next()
+    
+    def has_previous(self):
+        if self._has_previous is not None:
+            return self._has_previous
+        return super(WindowPage, self).has_previous()
+    
+    def start_index(self):
+        if self.paginator.count is None:
+            return (self.paginator.per_page * (self.number - 1)) + 1 if self.object_list else 0
+        return super(WindowPage, self).start_index()
+    
+    def end_index(self):
+        if self.paginator.count is None:
+            return (self.paginator.per_page * (self.number - 1)) + len(self.object_list)
+        return super(WindowPage, self).end_index()
+    
+    def _get_next_cursor(self):
+        if self.paginator.key is None or not self.object_list or not self.has_next():
+            return None
+        return self.paginator.encode_cursor(list(self.object_list)[-1], self.number + 1)
+    
+    next_cursor = property(_get_next_cursor)
+    
+    def _get_previous_cursor(self):
+        if self.paginator.key is None or not self.object_list or not self.has_previous():
+            return None
+        return self.paginator.encode_cursor(list(self.object_list)[0], self.number - 1, previous=True)
+    
+    previous_cursor = property(_get_previous_cursor)
     
     def _get_page_range(self):
-        if self.window and self.window + 2 < self.paginator.num_pages: # If a window is set, and that window plus the first and last pages is less than the total...
+        if self.paginator.count is None:
+            return self._get_open_page_range()
+        elif self.window and self.window + 2 < self.paginator.num_pages: # If a window is set, and that window plus the first and last pages is less than the total...
             
             # Calculate lower and higher window limits
             
@@ -72,4 +454,30 @@ class WindowPage(Page):
         else:
             return self.paginator._get_page_range()
     
-    page_range = property(_get_page_range)
\ No newline at end of file
+    page_range = property(_get_page_range)
+    
+    def _get_open_page_range(self):
+        
+        """
+        Page range for when the paginator doesn't know its count: the window is
+        only built up to the next page, followed by None if there are more pages, e.g.
+        a window of '5' on page 14 would yield: [1, None, 12, 13, 14, 15, None]
+        """
+        
+        lower = 2
+        higher = self.number + 1 if self.has_next() else self.number
+        
+        if self.window:
+            lower = max(lower, self.number - int(math.floor(float(self.window - 1) / 2)))
+        
+        pages = [1]
+        
+        if lower > 2:
+            pages.append(None)
+        
+        pages.extend(range(lower, higher + 1))
+        
+        if self.has_next():
+            pages.append(None)
+        
+        return pages
\ No newline at end of file
@@ -0,0 +1,168 @@
+from math import asin, cos, degrees, floor, pi, radians, sin, sqrt
+
+"""
+In-memory spatial index for (longitude, latitude) points, like the ones find_geo_point()
+returns, answering "what's near here" questions without a haversine over every row.
+
+Example:
+    
+    index = GridIndex.from_queryset(Store.objects.get_published(), 'lng', 'lat')
+    index.nearest((-122.676, 45.523), 5)    # [(distance in km, store pk), ...]
+    index.within((-122.676, 45.523), 10)    # Every store within 10 km, nearest first
+
+"""
+
+EARTH_RADIUS = 6371.0 # km
+KM_PER_DEGREE = EARTH_RADIUS * pi / 180
+
+def haversine(point1, point2):
+    
+    """
+    Great circle distance in km between two (longitude, latitude) points
+    """
+    
+    lng1, lat1 = radians(point1[0]), radians(point1[1])
+    lng2, lat2 = radians(point2[0]), radians(point2[1])
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+class GridIndex(object):
+    
+    """
+    Spatial index bucketing points into a grid of `cell_size` degree cells. Queries only look
+    at the cells a search circle overlaps, so they cost about the same no matter how many points
+    are indexed, as long as the cells are small next to the usual search radius and big next to
+    the gaps between points. Points can be added, moved and removed at any time.
+    
+    Points are stored under a key, typically a model instance's primary key.
+    """
+    
+    def __init__(self, cell_size=0.1):
+        self.cell_size = float(cell_size)
+        self.columns = int(floor(360 / self.cell_size)) or 1
+        self.points = {}
+        self.cells = {}
+    
+    @classmethod
+    def from_queryset(cls, queryset, lng_field='lng', lat_field='lat', cell_size=0.1):
+        
+        """
+        Build an index of primary key: point from a QuerySet, streaming it so only the
+        key and coordinates of one row are held at a time. Rows without coordinates are skipped.
+        """
+        
+        index = cls(cell_size)
+        
+        for pk, lng, lat in queryset.values_list('pk', lng_field, lat_field).iterator():
+            if lng is not None and lat is not None:
+                index.add(pk, (lng, lat))
+        
+        return index
+    
+    def __len__(self):
+        return len(self.points)
+    
+    def __contains__(self, key):
+        return key in self.points
+    
+    def add(self, key, point):
+        
+        """
+        Add a (longitude, latitude) point, or move it if the key is already indexed
+        """
+        
+        if key in self.points:
+            self.remove(key)
+        
+        lng, lat = float(point[0]), float(point[1])
+        self.points[key] = (lng, lat,)
+        lat_radians = radians(lat)
+        self.cells.setdefault(self._get_cell(lng, lat), {})[key] = (radians(lng), lat_radians, cos(lat_radians),)
+    
+    def remove(self, key):
+        lng, lat = self.points.pop(key)
+        cell = self._get_cell(lng, lat)
+        del self.cells[cell][key]
+        if not self.cells[cell]:
+            del self.cells[cell]
+    
+    def within(self, point, radius):
+        
+        """
+        Returns a list of (distance in km, key) tuples for every point within `radius` km, nearest first
+        """
+        
+        lng, lat = radians(point[0]), radians(point[1])
+        cos_lat = cos(lat)
+        results = []
+        limit = sin(min(radius, EARTH_RADIUS * pi) / (2 * EARTH_RADIUS)) ** 2 # Haversine `a` at the radius
+        
+        for cell in self._get_cells(point, radius):
+            for key, (other_lng, other_lat, other_cos_lat) in self.cells[cell].iteritems():
+                a = sin((other_lat - lat) / 2) ** 2 + cos_lat * other_cos_lat * sin((other_lng - lng) / 2) ** 2
+                if a <= limit:
+                    results.append((2 * EARTH_RADIUS * asin(min(1.0, sqrt(a))), key,))
+        
+        results.sort()
+        return results
+    
+    def nearest(self, point, k=1, radius=None):
+        
+        """
+        Returns a list of (distance in km, key) tuples for the `k` points nearest to `point`,
+        nearest first, optionally only looking as far as `radius` km
+        """
+        
+        # Widen the search until it turns up enough points, anything outside the
+        # search circle is farther than everything inside it
+        
+        search = self.cell_size * KM_PER_DEGREE
+        
+        while True:
+            if radius is not None and search >= radius:
+                return self.within(point, radius)[:k]
+            results = self.within(point, search)
+            if len(results) >= k or search >= EARTH_RADIUS * pi:
+                return results[:k]
+            search *= 2
+    
+    def _get_cell(self, lng, lat):
+        return (int(floor((lng + 180) / self.cell_size)) % self.columns, int(floor((lat + 90) / self.cell_size)),)
+    
+    def _get_cells(self, point, radius):
+        
+        """
+        Returns the occupied cells overlapping the bounding box of a search circle
+        """
+        
+        lng, lat = point
+        angle = radius / EARTH_RADIUS
+        lat_delta = degrees(angle)
+        lower, upper = lat - lat_delta, lat + lat_delta
+        
+        # The circle's longitude span widens towards the poles, and takes in every
+        # longitude if the circle reaches a pole
+        
+        if lower <= -90 or upper >= 90 or sin(angle) >= cos(radians(lat)):
+            columns = None
+        else:
+            lng_delta = degrees(asin(sin(angle) / cos(radians(lat))))
+            first = int(floor((lng - lng_delta + 180) / self.cell_size))
+            last = int(floor((lng + lng_delta + 180) / self.cell_size))
+            columns = set(column % self.columns for column in range(first, min(last, first + self.columns - 1) + 1))
+        
+        rows = (int(floor((max(lower, -90) + 90) / self.cell_size)), int(floor((min(upper, 90) + 90) / self.cell_size)),)
+        
+        # Walk whichever is smaller, the cells in the box or the occupied cells
+        
+        box_size = (rows[1] - rows[0] + 1) * (len(columns) if columns is not None else self.columns)
+        
+        if box_size < len(self.cells):
+            for column in (columns if columns is not None else range(self.columns)):
+                for row in range(rows[0], rows[1] + 1):
+                    if (column, row,) in self.cells:
+                        yield (column, row,)
+        else:
+            for cell in self.cells:
+                if rows[0] <= cell[1] <= rows[1] and (columns is None or cell[0] in columns):
+                    yield cell
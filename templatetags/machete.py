@@ -1,15 +1,29 @@
 import urllib
 import re
-from math import floor
 from django import template
+from django.conf import settings
+from django.db.models.query import QuerySet
 from django.template.base import Node
 from django.template.defaultfilters import stringfilter
 from django.utils.encoding import force_unicode, smart_str
 from django.utils.safestring import mark_safe
 from django.utils.html import urlize
+from ..columns import columnize, lazy_columnize
+from ..memoize import LRUCache, memoize
 
 register = template.Library()
 
+# Shared memoization for the text filters below, off unless MACHETE_FILTER_CACHE_SIZE
+# is set to the number of results to hold. Results are kept whole, so size it with the
+# length of the text going through the filters in mind.
+
+filter_cache = LRUCache(getattr(settings, 'MACHETE_FILTER_CACHE_SIZE', 0))
+
+# twitterize() gets its own, on by default, since tweets are short and the same ones
+# get rendered over and over. Set MACHETE_TWITTERIZE_CACHE_SIZE to 0 to turn it off.
+
+twitterize_cache = LRUCache(getattr(settings, 'MACHETE_TWITTERIZE_CACHE_SIZE', 1000))
+
 # ---- FILTERS
 
 @register.filter
@@ -22,6 +36,7 @@ def odd(value):
 
 @register.filter
 @stringfilter
+@memoize(filter_cache)
 def split(value, character):
 
     """
@@ -45,6 +60,7 @@ def urlquote_plus(url, safe='/'):
 
 @register.filter
 @stringfilter
+@memoize(filter_cache)
 def urlencode_plus(value, safe=None):
     
     """
@@ -78,6 +94,7 @@ def possessive(value):
 
 @register.filter
 @stringfilter
+@memoize(filter_cache)
 def make_paragraphlist(value):
     
     """
@@ -99,24 +116,63 @@ def make_paragraphlist(value):
     value = re.sub(r'[ \t]*(\r\n|\r|\n)[ \t]*', '\n', force_unicode(value)) # normalize newlines
     return re.split('\n{2,}', value)
 
+# Twitter link patterns, matched against each whitespace-separated word
+
+twitter_word_split_re = re.compile(r'(\s+)')
+twitter_mention_re = re.compile(r'@([a-zA-Z0-9\-_]*)\b')
+twitter_hashtag_re = re.compile(r'#([a-zA-Z0-9\-_]*)\b')
+
 @register.filter
 @stringfilter
+@memoize(twitterize_cache)
 def twitterize(value):
 
     """
-    Replace Twitter @ and # references with links to the user/hashtag
+    Replace Twitter @ and # references with links to the user/hashtag, and URLs with links
+    (same as Django's urlize), all opening in a new window. Results are memoized, since the
+    same tweets tend to get rendered over and over.
     """
 
-    value = urlize(value)
-    value = re.sub(r'(\s+|\A)@([a-zA-Z0-9\-_]*)\b',r'\1<a href="http://twitter.com/\2">@\2</a>', value)
-    value = re.sub(r'(\s+|\A)#([a-zA-Z0-9\-_]*)\b',r'\1<a href="http://search.twitter.com/search?q=%23\2">#\2</a>',value)
-    return mark_safe(value.replace('<a ', '<a target="_blank" '))
+    # Go through the text word by word, the same way urlize does, so URLs,
+    # mentions and hashtags are all linked in a single pass
+    
+    words = twitter_word_split_re.split(value)
+    
+    for i in range(0, len(words), 2):
+        word = words[i]
+        
+        if not word:
+            continue
+        
+        if '.' in word or '@' in word or ':' in word:
+            linked = urlize(word)
+            if linked != word:
+                word = linked.replace('<a ', '<a target="_blank" ')
+        
+        if word[0] == '@':
+            match = twitter_mention_re.match(word)
+            if match:
+                word = u'<a target="_blank" href="http://twitter.com/%s">@%s</a>%s' % (match.group(1), match.group(1), word[match.end():])
+        elif word[0] == '#':
+            match = twitter_hashtag_re.match(word)
+            if match:
+                word = u'<a target="_blank" href="http://search.twitter.com/search?q=%%23%s">#%s</a>%s' % (match.group(1), match.group(1), word[match.end():])
+        
+        # Any '<a ' tag already in the text gets a target too
+        
+        if word.endswith('<a') and i + 1 < len(words) and words[i + 1][0] == ' ':
+            word += ' target="_blank"'
+        
+        words[i] = word
+    
+    return mark_safe(u''.join(words))
 
 # ---- TAGS
 
 # Regex for token keyword arguments
 
 kwarg_re = re.compile(r"(?:(\w+\[?\]?\+?\-?)=)?(.+)")
+var_re = re.compile(r"^\w+\[?\]?\+?\-?$")
 
 def token_kwargs(bits, parser, support_legacy=False):
     
@@ -156,6 +212,53 @@ def token_kwargs(bits, parser, support_legacy=False):
             del bits[:1]
     return kwargs
 
+# Query string operations, see CompiledQueryString.apply()
+
+QUERYSTRING_SET = 0
+QUERYSTRING_APPEND = 1
+QUERYSTRING_REMOVE = 2
+
+def parse_querystring_var(var):
+    
+    """
+    Split a query string variable like 'artists[]+' into its name and operation
+    """
+    
+    if var[-1] == '+':
+        return var[0:-1], QUERYSTRING_APPEND
+    elif var[-1] == '-':
+        return var[0:-1], QUERYSTRING_REMOVE
+    return var, QUERYSTRING_SET
+
+def querystring_operations(overrides):
+    
+    """
+    Turn (variable, value) pairs into (name, operation, value, encoded) tuples for CompiledQueryString
+    """
+    
+    return [parse_querystring_var(var) + (value, None,) for var, value in overrides]
+
+def literal_value(filter_expression):
+    
+    """
+    Returns a (is_literal, value) tuple, where is_literal is True if the filter expression
+    is a constant like 'foo', 2011 or None, which doesn't need the context to resolve
+    """
+    
+    if filter_expression.filters:
+        return False, None
+    
+    var = filter_expression.var
+    
+    if not isinstance(var, template.Variable):
+        return True, var
+    elif var.lookups is None and not var.translate:
+        return True, var.literal
+    elif var.var == 'None':
+        return True, None
+    
+    return False, None
+
 class QueryStringNode(Node):
     
     """
@@ -177,6 +280,23 @@ class QueryStringNode(Node):
         self.query_string_data = template.Variable(self.query_string_var)
         self.arguments = arguments
         self.append = append
+        
+        # Work out everything that doesn't depend on the context up front: the operation and
+        # name for each variable, and the value and encoding for literal 'set' arguments
+        
+        self.operations = []
+        
+        for var, filter_expression in arguments.items():
+            name, operation = parse_querystring_var(var)
+            is_literal, value = literal_value(filter_expression)
+            encoded = None
+            
+            if is_literal:
+                if operation == QUERYSTRING_SET and value:
+                    encoded = CompiledQueryString.encode(name, value)
+                filter_expression = None
+            
+            self.operations.append((name, operation, filter_expression, value, encoded,))
     
     def render(self, context):
         
@@ -184,62 +304,198 @@ class QueryStringNode(Node):
         Render query string
         """
         
-        from copy import deepcopy
+        return self.get_compiled(context).render(self.resolve_arguments(context), self.append)
+    
+    def get_compiled(self, context):
         
-        # Grab query string context var
+        """
+        Grab query string context var, compiled once per base dict per template render
+        """
         
         try:
-            query_string_data = deepcopy(self.query_string_data.resolve(context))
-            if type(query_string_data) != dict:
-                raise Exception()
-        except:
-            # Default to an empty query string dict
-            query_string_data = {}
-        
-        # Sort through arguments and update query string data accordingly
-        
-        if self.arguments:
-            for var, filter_expression in self.arguments.items():
-                value = filter_expression.resolve(context, True)
-                
-                append = var[-1] == '+'
-                remove = var[-1] == '-'
-                if append or remove: var = var[0:-1]
-                
-                if query_string_data.has_key(var):
-                    if type(query_string_data[var]) is list and (append or remove):
-                        if remove:
-                            try:
-                                ind = query_string_data[var].index(value)
-                                del query_string_data[var][ind]
-                            except:
-                                pass
-                        else:
-                            query_string_data[var].append(value)
-                    elif value == None:
-                        del query_string_data[var]
-                    elif value:
-                        query_string_data[var] = value
+            query_string_data = self.query_string_data.resolve(context)
+        except template.VariableDoesNotExist:
+            query_string_data = None
+        
+        return CompiledQueryString.for_context(context, query_string_data)
+    
+    def resolve_arguments(self, context):
+        
+        """
+        Resolve token arguments into a list of (name, operation, value, encoded) operations
+        """
+        
+        return [(name, operation, value if filter_expression is None else filter_expression.resolve(context, True), encoded,) for name, operation, filter_expression, value, encoded in self.operations]
+
+class CompiledQueryString(object):
+    
+    """
+    A base query string dictionary with each of its keys already URL encoded, so rendering
+    a variation of it (one per facet link, say) only has to encode the keys that change
+    instead of copying and re-encoding the whole thing
+    """
+    
+    context_key = 'machete.querystring.compiled'
+    
+    # Base for anything that isn't a dict, never changed
+    
+    empty = {}
+    
+    def __init__(self, data, encoded=None):
+        
+        """
+            `data`      (dict)  The base query string dictionary. It's not copied, so it shouldn't
+                                change while the compiled version is in use
+            `encoded`   (dict)  Already encoded keys to reuse, see overlay()
+        """
+        
+        self.data = data
+        self.keys = data.keys()
+        self.encoded = encoded or {}
+        
+        for key in self.keys:
+            if not self.encoded.has_key(key):
+                self.encoded[key] = self.encode(key, self.data[key])
+    
+    @classmethod
+    def for_context(cls, context, data):
+        
+        """
+        Return the compiled version of `data` for the current template render, compiling
+        it on first use. Anything that isn't a dict compiles as an empty query string.
+        """
+        
+        # Share one empty dict, so a missing base compiles once per render rather than once per call
+        
+        if type(data) != dict:
+            data = cls.empty
+        
+        cache = context.render_context.get(cls.context_key)
+        
+        if cache is None:
+            cache = context.render_context[cls.context_key] = {}
+        
+        # Keep a reference to the base dict alongside so its id can't get reused
+        
+        cached = cache.get(id(data))
+        
+        if cached is None or cached[0] is not data:
+            cached = cache[id(data)] = (data, cls(data),)
+        
+        return cached[1]
+    
+    @staticmethod
+    def encode(key, value):
+        
+        """
+        URL encode a single key, using 'key[]=' pairs for lists and tuples
+        """
+        
+        if type(value) in [list, tuple]:
+            key = str(key).rstrip('[]') + '[]'
+            return urllib.urlencode([(key, smart_str(item),) for item in value])
+        return urllib.urlencode([(key, smart_str(value),)])
+    
+    def apply(self, operations, encoded=None):
+        
+        """
+        Apply a list of (name, operation, value, encoded) operations, see querystring_operations().
+        Returns a dict of only the keys that changed, with None for keys that were removed.
+        
+        `encoded` is an optional dict that gets filled with the pre-encoded values of keys
+        whose final value came from an operation carrying one
+        """
+        
+        changed = {}
+        
+        for var, operation, value, encoded_value in operations:
+            
+            append = operation == QUERYSTRING_APPEND
+            remove = operation == QUERYSTRING_REMOVE
+            
+            if encoded is not None:
+                if encoded_value:
+                    encoded[var] = encoded_value
+                else:
+                    encoded.pop(var, None)
+            
+            if var in changed:
+                current = changed[var]
+                exists = current is not None
+            else:
+                exists = self.data.has_key(var)
+                current = self.data[var] if exists else None
+            
+            if exists:
+                if type(current) is list and (append or remove):
+                    current = current[:] # Copy so the base list is left alone
+                    if remove:
+                        try:
+                            current.remove(value)
+                        except ValueError:
+                            pass
+                    else:
+                        current.append(value)
+                    changed[var] = current
+                elif value == None:
+                    changed[var] = None
                 elif value:
-                    query_string_data[var] = [value] if append else value
+                    changed[var] = value
+            elif value:
+                changed[var] = [value] if append else value
+        
+        return changed
+    
+    def overlay(self, operations):
+        
+        """
+        Returns a new CompiledQueryString with `operations` applied, reusing the
+        encoding of every key they don't touch
+        """
+        
+        changed = self.apply(operations) if operations else {}
         
-        # Preparse for encoding
+        if not changed:
+            return self
         
-        query_string_data_list = []
+        data = dict(self.data)
+        encoded = dict((key, self.encoded[key]) for key in self.keys if not changed.has_key(key))
         
-        for key in query_string_data.keys():
-            value = query_string_data[key]
-            if type(value) in [list, tuple]:
-                key = str(key).rstrip('[]') + '[]'
-                for item in value:
-                    query_string_data_list.append((key, str(item),))
+        for key, value in changed.items():
+            if value is None:
+                data.pop(key, None)
             else:
-                query_string_data_list.append((key, str(value),))
+                data[key] = value
+        
+        return CompiledQueryString(data, encoded)
+    
+    def render_many(self, var, values, append=False):
+        
+        """
+        Render one query string per value in `values`, with `var` (which can end in '+'
+        or '-' like any override) set to that value. Returns a list of (value, query string) tuples.
+        """
+        
+        name, operation = parse_querystring_var(var)
+        return [(value, self.render([(name, operation, value, None,)], append),) for value in values]
+    
+    def render(self, operations=None, append=False):
+        
+        """
+        Render the query string with `operations` applied (see apply()), starting with
+        a '&' instead of a '?' if `append` is True
+        """
+        
+        encoded = {}
+        changed = self.apply(operations, encoded) if operations else {}
         
-        # Build and return query string
+        # One part per remaining key, empty lists encode to nothing
         
-        if query_string_data:
-            return '%s%s' % ('&' if self.append else '?', urllib.urlencode(query_string_data_list))
+        parts = [self.encoded[key] for key in self.keys if not changed.has_key(key)]
+        parts.extend([encoded.get(key) or self.encode(key, value) for key, value in changed.items() if value is not None])
+        
+        if parts:
+            return '%s%s' % ('&' if append else '?', '&'.join([part for part in parts if part]))
         else:
             return ''
 
@@ -279,8 +535,8 @@ def do_querystring(parser, token):
     
     try:
         query_string_data = bits[1]
-    except:
-        raise template.TemplateSyntaxError('%s tag requires at least one argument: a base query string dictionary')
+    except IndexError:
+        raise template.TemplateSyntaxError('%s tag requires at least one argument: a base query string dictionary' % tag)
     
     # Check for arguments
     
@@ -296,21 +552,120 @@ def do_querystring(parser, token):
         
         # Parse remaining arguments
         
-        try:
-            arguments = token_kwargs(remaining_bits, parser)
-        except:
-            arguments = {}
+        arguments = token_kwargs(remaining_bits, parser)
     
     return QueryStringNode(query_string_data, arguments, append)
 
+class QueryStringsNode(QueryStringNode):
+    
+    """
+    Handle querystrings tag parsing
+    """
+    
+    def __init__(self, query_string, target, values, var=None, arguments={}, append=False):
+        
+        """
+        Query strings init
+            
+            `target`    (str)               Context variable to store the resulting list of (value, query string) tuples into
+            `values`    (FilterExpression)  The list of values to loop through, or list of override dicts if `var` isn't set
+            `var`       (str)               The query string variable to set to each of the values
+        
+        See QueryStringNode for the rest
+        """
+        
+        super(QueryStringsNode, self).__init__(query_string, arguments, append)
+        self.target = target
+        self.values = values
+        self.var = var
+    
+    def render(self, context):
+        
+        """
+        Render all the query strings in one go, off one base with the shared arguments already applied
+        """
+        
+        compiled = self.get_compiled(context).overlay(self.resolve_arguments(context))
+        values = self.values.resolve(context, True) or []
+        
+        if self.var:
+            context[self.target] = compiled.render_many(self.var, values, self.append)
+        else:
+            context[self.target] = [(overrides, compiled.render(querystring_operations(overrides.items()), self.append),) for overrides in values]
+        
+        return ''
+
+@register.tag(name='querystrings')
+def do_querystrings(parser, token):
+    
+    """
+    Batch version of the querystring tag: builds a list of query strings off one base query string dictionary,
+    either by setting a single variable to each value of a list, or by applying each set of overrides from a list
+    of dicts. The results are stored as a list of (value, query string) tuples. Any other arguments are applied
+    to every query string, same as with the querystring tag.
+    
+    Usage:
+        
+        base_query_string = {'page': 3, 'sort': 'date'}
+        facets = ['rock', 'jazz']
+        {% querystrings base_query_string page=None for genre in facets as facet_links %}
+        {% for facet, query_string in facet_links %}<a href="{{ query_string }}">{{ facet }}</a>{% endfor %}
+        '<a href="?sort=date&genre=rock">rock</a><a href="?sort=date&genre=jazz">jazz</a>'
+        
+        base_query_string = {'page': 3}
+        overrides = [{'sort': 'date'}, {'sort': 'title', 'page': None}]
+        {% querystrings base_query_string from overrides as sort_links %}
+        sort_links = [({'sort': 'date'}, '?page=3&sort=date'), ({'sort': 'title', 'page': None}, '?sort=title')]
+    
+    Pass 'append' keyword before 'for'/'from' for the query strings to start with a '&' instead of a '?'
+    
+    """
+    
+    bits = token.split_contents()
+    tag = bits.pop(0)
+    var = None
+    
+    if len(bits) < 5 or bits[-2] != 'as':
+        raise template.TemplateSyntaxError("'%s' tag requires a base query string dictionary, 'for var in values' or 'from overrides', and 'as' followed by a variable name" % tag)
+    
+    target = bits[-1]
+    query_string_data = bits[0]
+    bits = bits[1:-2]
+    
+    # Check for 'for var in values' or 'from overrides'
+    
+    if len(bits) >= 4 and bits[-4] == 'for' and bits[-2] == 'in':
+        var = bits[-3]
+        if not var_re.match(var):
+            raise template.TemplateSyntaxError("'%s' is not a valid query string variable name for '%s'" % (var, tag))
+        values = bits[-1]
+        bits = bits[:-4]
+    elif len(bits) >= 2 and bits[-2] == 'from':
+        values = bits[-1]
+        bits = bits[:-2]
+    else:
+        raise template.TemplateSyntaxError("'%s' tag requires either 'for var in values' or 'from overrides' before 'as'" % tag)
+    
+    # Check for 'append'
+    
+    append = 'append' in bits
+    if append: bits.remove('append')
+    
+    arguments = token_kwargs(bits, parser)
+    
+    if bits:
+        raise template.TemplateSyntaxError("'%s' tag received invalid arguments: %s" % (tag, ' '.join(bits)))
+    
+    return QueryStringsNode(query_string_data, target, parser.compile_filter(values), var, arguments, append)
+
 class ColumnizeNode(Node):
     
     
     """
-    Handle 'columnize' tag parsing
+    Handle 'columnize' tag parsing, see columns.py for the actual columnizing
     """
     
-    def __init__(self, expression, target, columns, stacked=False):
+    def __init__(self, expression, target, columns, stacked=False, lazy=False):
         
         """
         Columnize init
@@ -322,6 +677,7 @@ class ColumnizeNode(Node):
                             the data is sorted into columns by alternating through the source, setting
                             this to True would break the contents of the source into columns, maintaining
                             its initial order.
+            `lazy`          Whether QuerySet sources should be split up without being evaluated, see columns.lazy_columnize()
         
         """
         
@@ -329,51 +685,21 @@ class ColumnizeNode(Node):
         self.target = target
         self.columns = columns
         self.stacked = stacked
+        self.lazy = lazy
     
     def render(self, context):
         
         source_list = self.expression.resolve(context, True)
         
+        if self.lazy and isinstance(source_list, QuerySet):
+            context[self.target] = lazy_columnize(source_list, self.columns, self.stacked)
+            return ''
+        
         if not source_list:
             context[self.target] = []
             return ''
         
-        out = [[] for i in range(self.columns)]
-        lengths = [0 for i in range(self.columns)]
-        
-        # Figure out how long each column should be
-        
-        if self.stacked:
-            total = len(source_list)
-            rem = total % self.columns
-            
-            if total > self.columns:
-                lengths = [int(floor(float(total) / float(self.columns)))] * self.columns
-            
-            if rem:
-                i = 0
-                while rem:
-                    lengths[i] += 1
-                    rem -= 1
-                    i += 1
-            
-        # Sort into columns
-        
-        i = 0
-        column = 0
-        
-        for item in source_list:
-            
-            out[column].append(item)
-            i += 1
-            
-            if self.stacked:
-                if len(out[column]) == lengths[column]:
-                    column += 1
-            else:
-                column = i % self.columns
-        
-        context[self.target] = out
+        context[self.target] = columnize(source_list, self.columns, self.stacked)
         
         return ''
 
@@ -418,6 +744,10 @@ def do_columnize(parser, token):
         Separate the contents of 'yay_var' into 8 columns in its original order (stacked) and store as 'yay_columns'
         
         {% columnize yay_var into 8 stacked as yay_columns %}
+        
+        Separate the QuerySet 'products' into 4 columns without loading every product into memory at once (lazy)
+        
+        {% columnize products into 4 lazy as product_columns %}
     
     """
     
@@ -449,6 +779,14 @@ def do_columnize(parser, token):
         stacked = True
         bits.pop(0)
     
+    # Validate optional 'lazy' keyword
+    
+    lazy = False
+    
+    if bits and bits[0] == 'lazy':
+        lazy = True
+        bits.pop(0)
+    
     if bits:
         if len(bits) == 2 and bits[-2] == 'as':
             target = bits[-1]
@@ -461,7 +799,7 @@ def do_columnize(parser, token):
     
     expression = parser.compile_filter(source)
     
-    return ColumnizeNode(expression, target, columns, stacked)
+    return ColumnizeNode(expression, target, columns, stacked, lazy)
 
 class TruncateStringNode(Node):
     
@@ -1,9 +1,76 @@
+import os
+import pickle
+import random
+import simplejson
+import tempfile
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from datetime import datetime
 from pprint import pprint
 from urlparse import parse_qs
-from django.test import TestCase
-from django.template import Context, Template
-from google_maps import find_geo, find_geo_point
-from paginator import WindowPaginator, WindowPage
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.core.paginator import InvalidPage
+from django.db import connection, models, transaction
+from django.test import TestCase, TransactionTestCase
+from django.template import Context, Template, TemplateSyntaxError
+from django.utils.hashcompat import md5_constructor
+from admin import StatusJob, get_job_progress, make_draft, make_published, set_status, update_status
+from auth import backends
+from auth.backends import ModelBackendFlexible, PasswordVerifier, get_cache_key, needs_rehash
+from auth.indexes import create_email_index, drop_email_index, filter_email, get_email_index_sql
+from columns import column_bounds, columnize, chunk, grid
+import google_maps
+from google_maps import GeocodeCache, RateLimiter, batch_find_geo_point, find_geo, find_geo_point, normalize_location
+from gazetteer import Gazetteer
+from indexes import create_published_indexes, drop_published_indexes, get_published_index_sql
+from memoize import LRUCache, memoize, missing
+from models import GlobalModel, STATUS_DRAFT, STATUS_PUBLISHED, dump_watermark, get_cache_stats, get_watermark, get_watermark_filter, load_watermark, reset_cache_stats
+from paginator import WindowPaginator, WindowPage, CachedCount, ApproximateCount, NoCount
+from spatial import GridIndex, haversine
+from templatetags.machete import CompiledQueryString, filter_cache, twitterize_cache
+from twitter import TwitterClient, TwitterRefresher, Tweet, parse_created_at
+
+# ---- TEST MODELS
+
+class Article(GlobalModel):
+    
+    """
+    Concrete GlobalModel subclass to run model/queryset tests against
+    """
+    
+    title = models.CharField(max_length=100)
+    
+    class Meta:
+        app_label = 'machete'
+
+class Place(models.Model):
+    
+    """
+    Geocoded model to build spatial indexes from
+    """
+    
+    name = models.CharField(max_length=100)
+    lng = models.FloatField(null=True)
+    lat = models.FloatField(null=True)
+    
+    class Meta:
+        app_label = 'machete'
+
+class Listing(GlobalModel):
+    
+    """
+    GlobalModel subclass with a ForeignKey, to upsert by
+    """
+    
+    place = models.ForeignKey(Place)
+    title = models.CharField(max_length=100)
+    
+    class Meta:
+        app_label = 'machete'
 
 # ---- UTILITY
 
@@ -58,6 +125,86 @@ class BaseTestCase(TestCase):
             return ', '.join(['%s: %s' % (row[0], ', '.join(row[1])) for row in form.errors.items()])
         return ''
 
+# ---- STAND-IN SERVERS
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    
+    """
+    Local HTTP server to point API clients at in tests. `responses` maps
+    request paths (without the query string) to (status, body) tuples, or
+    to functions taking the parsed query string and returning one. A response
+    of None drops the connection without replying.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInRequestHandler)
+        self.url = 'http://127.0.0.1:%d/' % self.server_port
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    
+    protocol_version = 'HTTP/1.1' # Keep-alive
+    
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        path, query = (self.path.split('?', 1) + [''])[:2]
+        response = self.server.responses.get(path, (404, ''))
+        response = response(parse_qs(query)) if callable(response) else response
+        if response is None:
+            self.close_connection = 1
+            return
+        status, body = response
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+def explain(queryset):
+    
+    """
+    Returns SQLite's query plan for a QuerySet as a string
+    """
+    
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+    return ' '.join(str(row) for row in cursor.fetchall())
+
+def stand_in_geocoder(query):
+    
+    """
+    Stand-in for Google's geocoder, knowing a couple of places
+    """
+    
+    places = {
+        'portland, or': ('Portland, OR, USA', -122.676, 45.523),
+        'los angeles, ca': ('Los Angeles, CA, USA', -118.243, 34.052),
+    }
+    
+    location = query.get('q', [''])[0].lower()
+    
+    if location == 'over the limit':
+        return 200, simplejson.dumps({'Status': {'code': 620}})
+    if location not in places:
+        return 200, simplejson.dumps({'Status': {'code': 602}})
+    
+    address, lng, lat = places[location]
+    return 200, simplejson.dumps({'Status': {'code': 200}, 'Placemark': [{'address': address, 'Point': {'coordinates': [lng, lat, 0]}}]})
+
 # ---- TEST CASES
 
 class GoogleMapsTestCase(TestCase):
@@ -83,6 +230,486 @@ class GoogleMapsTestCase(TestCase):
         
         self.assertFalse(find_geo(''), "Blank location doesn't return false")
 
+class GeocodeCacheTestCase(TestCase):
+    
+    """
+    Test case for google_maps.py caching, against a local stand-in geocoder
+    """
+    
+    def setUp(self):
+        self.server = StandInServer({'/': stand_in_geocoder})
+        self.path = tempfile.mktemp(suffix='.sqlite')
+        self.old_cache = google_maps.geocode_cache
+        google_maps.geocode_cache = GeocodeCache(self.path)
+        settings.MACHETE_GEOCODER_URL = self.server.url
+    
+    def tearDown(self):
+        self.server.stop()
+        google_maps.geocode_cache = self.old_cache
+        del settings.MACHETE_GEOCODER_URL
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    def test_normalize_location(self):
+        self.assertEqual(normalize_location(' 7719 N. McKenna Ave. ,  Portland, OR.'), u'7719 n mckenna ave,portland,or')
+        self.assertEqual(normalize_location('PORTLAND,OR'), normalize_location('Portland , OR'))
+    
+    def test_find_geo_point(self):
+        
+        self.assertEqual(find_geo_point('Portland, OR'), ('Portland, OR, USA', (-122.676, 45.523)))
+        self.assertEqual(find_geo_point('  portland ,or. '), ('Portland, OR, USA', (-122.676, 45.523)))
+        self.assertEqual(len(self.server.requests), 1)
+        
+        # Misses are cached too, errors aren't
+        
+        self.assertEqual(find_geo_point('Nowhere'), False)
+        self.assertEqual(find_geo_point('nowhere'), False)
+        self.assertEqual(find_geo_point('Over the limit'), False)
+        self.assertEqual(find_geo_point('Over the limit'), False)
+        self.assertEqual(len(self.server.requests), 4)
+        
+        # Served from the SQLite file by a new process
+        
+        google_maps.geocode_cache = GeocodeCache(self.path)
+        
+        self.assertEqual(find_geo_point('Portland, OR'), ('Portland, OR, USA', (-122.676, 45.523)))
+        self.assertEqual(find_geo_point('Nowhere'), False)
+        self.assertEqual(len(self.server.requests), 4)
+    
+    def test_batch_find_geo_point(self):
+        
+        find_geo_point('Los Angeles, CA')
+        
+        # Fails the first time round, to be retried
+        
+        attempts = []
+        
+        def flaky_geocoder(query):
+            if query['q'] == ['Portland, OR'] and not attempts:
+                attempts.append(1)
+                return 500, ''
+            return stand_in_geocoder(query)
+        
+        self.server.responses['/'] = flaky_geocoder
+        
+        locations = ['Portland, OR', 'Los Angeles, CA', 'Nowhere', 'portland, or.', '', 'Over the limit']
+        results = dict(batch_find_geo_point(locations, rate=1000, retries=2, backoff=0.01))
+        
+        self.assertEqual(results, {
+            'Portland, OR': ('Portland, OR, USA', (-122.676, 45.523)),
+            'portland, or.': ('Portland, OR, USA', (-122.676, 45.523)),
+            'Los Angeles, CA': ('Los Angeles, CA, USA', (-118.243, 34.052)),
+            'Nowhere': False,
+            '': False,
+            'Over the limit': False,
+        })
+        
+        # Los Angeles came from the cache, Portland was retried once and over the limit three times
+        
+        self.assertEqual(len(self.server.requests), 1 + 2 + 1 + 3)
+        self.assertEqual(find_geo_point('Portland, OR'), ('Portland, OR, USA', (-122.676, 45.523)))
+        self.assertEqual(len(self.server.requests), 7)
+    
+    def test_dropped_connection(self):
+        
+        self.server.responses['/'] = lambda query: None
+        
+        self.assertRaises(google_maps.GeocodeError, google_maps.query_geo, 'Portland, OR')
+        self.assertEqual(find_geo_point('Portland, OR'), False)
+    
+    def test_batch_find_geo_dropped_connection(self):
+        
+        self.server.responses['/'] = lambda query: None if query['q'] == ['Portland, OR'] else stand_in_geocoder(query)
+        results = dict(batch_find_geo_point(['Portland, OR', 'Los Angeles, CA'], workers=2, rate=1000, retries=1, backoff=0.01))
+        
+        self.assertEqual(results, {
+            'Portland, OR': False,
+            'Los Angeles, CA': ('Los Angeles, CA, USA', (-118.243, 34.052)),
+        })
+    
+    def test_rate_limiter(self):
+        
+        limiter = RateLimiter(50, burst=5)
+        start = time.time()
+        
+        for i in range(0, 15):
+            limiter.acquire()
+        
+        self.assertAlmostEqual(time.time() - start, 0.2, delta=0.1)
+    
+    def test_timeouts(self):
+        
+        cache = GeocodeCache(self.path, timeout=60, negative_timeout=-1)
+        cache.set('portland, or', {'Status': {'code': 200}})
+        cache.set('nowhere', False)
+        
+        self.assertEqual(cache.get('portland, or'), {'Status': {'code': 200}})
+        self.assertEqual(cache.get('nowhere'), missing)
+        
+        cache.purge()
+        cache = GeocodeCache(self.path)
+        
+        self.assertEqual(cache.get('portland, or'), {'Status': {'code': 200}})
+        self.assertEqual(cache.get('nowhere'), missing)
+        
+        cache.clear()
+        
+        self.assertEqual(cache.get('portland, or'), missing)
+
+class GazetteerTestCase(TestCase):
+    
+    """
+    Test case for gazetteer.py
+    """
+    
+    gazetteer = 'address,lng,lat\n"Portland, OR, USA",-122.676,45.523\n"Los Angeles, CA, USA",-118.243,34.052\n"Seattle, WA, USA",-122.332,47.606\nbroken row\n"portland,  or, usa.",0,0\n'
+    
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.csv')
+        with open(self.path, 'w') as gazetteer:
+            gazetteer.write(self.gazetteer)
+    
+    def tearDown(self):
+        for path in (self.path, self.path + '.index'):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_find_geo_point(self):
+        
+        gazetteer = Gazetteer(self.path)
+        
+        self.assertEqual(len(gazetteer), 3)
+        self.assertEqual(gazetteer.find_geo_point('Portland, OR, USA'), (u'Portland, OR, USA', (-122.676, 45.523)))
+        self.assertEqual(gazetteer.find_geo_point('  seattle , wa, usa.'), (u'Seattle, WA, USA', (-122.332, 47.606)))
+        self.assertEqual(gazetteer.find_geo_point('Nowhere'), False)
+        self.assertEqual(gazetteer.find_geo_point('zzz'), False)
+        self.assertEqual(gazetteer.find_geo_point(''), False)
+        
+        # Rebuilt when the gazetteer changes
+        
+        with open(self.path, 'a') as f:
+            f.write('"Nowhere",1,2\n')
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        
+        self.assertEqual(Gazetteer(self.path).find_geo_point('nowhere'), (u'Nowhere', (1.0, 2.0)))
+    
+    def test_concurrent_build(self):
+        
+        errors = []
+        
+        def build():
+            try:
+                Gazetteer(self.path).build_index()
+            except Exception, e:
+                errors.append(e)
+        
+        threads = [threading.Thread(target=build) for i in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(errors, [])
+        self.assertEqual(len(Gazetteer(self.path)), 3)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(self.path)) if name.startswith(os.path.basename(self.path)) and name.endswith('.tmp')], [])
+    
+    def test_reverse_geo_point(self):
+        
+        gazetteer = Gazetteer(self.path)
+        
+        self.assertEqual(gazetteer.reverse_geo_point((-122.6, 45.6)), (u'Portland, OR, USA', (-122.676, 45.523)))
+        self.assertEqual(gazetteer.reverse_geo_point((-118, 34), max_distance=50), (u'Los Angeles, CA, USA', (-118.243, 34.052)))
+        self.assertEqual(gazetteer.reverse_geo_point((0, 0), max_distance=50), False)
+    
+    def test_google_maps_backend(self):
+        
+        old_cache = google_maps.geocode_cache
+        google_maps.geocode_cache = GeocodeCache()
+        settings.MACHETE_GEOCODE_GAZETTEER = self.path
+        
+        try:
+            self.assertEqual(find_geo_point('Seattle, WA, USA'), (u'Seattle, WA, USA', (-122.332, 47.606)))
+            self.assertEqual(dict(batch_find_geo_point(['Los Angeles, CA, USA', 'Nowhere'])), {
+                'Los Angeles, CA, USA': (u'Los Angeles, CA, USA', (-118.243, 34.052)),
+                'Nowhere': False,
+            })
+        finally:
+            del settings.MACHETE_GEOCODE_GAZETTEER
+            google_maps.geocode_cache = old_cache
+
+class SpatialTestCase(TestCase):
+    
+    """
+    Test case for spatial.py
+    """
+    
+    places = {
+        'Portland': (-122.676, 45.523),
+        'Seattle': (-122.332, 47.606),
+        'Los Angeles': (-118.243, 34.052),
+        'New York': (-74.006, 40.713),
+        'Fiji': (179.9, -17.7),
+        'Samoa': (-179.9, -17.7),
+    }
+    
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine(self.places['Portland'], self.places['Seattle']), 233.9, delta=1)
+        self.assertAlmostEqual(haversine(self.places['Fiji'], self.places['Samoa']), 21.2, delta=1)
+    
+    def test_grid_index(self):
+        
+        index = GridIndex(1)
+        
+        for name, point in self.places.items():
+            index.add(name, point)
+        
+        self.assertEqual(len(index), 6)
+        self.assertEqual([name for distance, name in index.nearest(self.places['Portland'], 3)], ['Portland', 'Seattle', 'Los Angeles'])
+        self.assertEqual([name for distance, name in index.within(self.places['Portland'], 300)], ['Portland', 'Seattle'])
+        self.assertEqual(index.nearest(self.places['Portland'], 3, radius=300), index.within(self.places['Portland'], 300))
+        
+        # Across the antimeridian
+        
+        self.assertEqual([name for distance, name in index.nearest(self.places['Fiji'], 2)], ['Fiji', 'Samoa'])
+        
+        # Updates
+        
+        index.add('Seattle', self.places['New York'])
+        index.remove('New York')
+        
+        self.assertEqual('New York' in index, False)
+        self.assertEqual([name for distance, name in index.within(self.places['New York'], 10)], ['Seattle'])
+        self.assertEqual([name for distance, name in index.within(self.places['Portland'], 300)], ['Portland'])
+    
+    def test_grid_index_matches_linear_scan(self):
+        
+        random.seed(1)
+        points = dict((i, (random.uniform(-180, 180), random.uniform(-90, 90))) for i in range(0, 2000))
+        index = GridIndex(5)
+        
+        for key, point in points.items():
+            index.add(key, point)
+        
+        for origin in [(0, 0), (179.9, 10), (10, 89.9), (-122.676, 45.523)]:
+            distances = sorted((haversine(origin, point), key) for key, point in points.items())
+            self.assertEqual([key for distance, key in index.nearest(origin, 10)], [key for distance, key in distances[:10]])
+            self.assertEqual([key for distance, key in index.within(origin, 1000)], [key for distance, key in distances if distance <= 1000])
+    
+    def test_from_queryset(self):
+        
+        for name, (lng, lat) in self.places.items():
+            Place.objects.create(name=name, lng=lng, lat=lat)
+        
+        Place.objects.create(name='Nowhere')
+        
+        index = GridIndex.from_queryset(Place.objects.all())
+        distance, pk = index.nearest(self.places['Seattle'])[0]
+        
+        self.assertEqual(len(index), 6)
+        self.assertEqual(Place.objects.get(pk=pk).name, 'Seattle')
+
+class ColumnsTestCase(TestCase):
+    
+    """
+    Test case for columns.py
+    """
+    
+    def test_columnize(self):
+        
+        items = range(1, 10)
+        
+        self.assertEqual(column_bounds(9, 4), [(0, 3), (3, 5), (5, 7), (7, 9)])
+        self.assertEqual(columnize(items, 4), [[1, 5, 9], [2, 6], [3, 7], [4, 8]])
+        self.assertEqual(columnize(items, 4, stacked=True), [[1, 2, 3], [4, 5], [6, 7], [8, 9]])
+        self.assertEqual(columnize(iter([1, 2]), 3, stacked=True), [[1], [2], []])
+        
+        # Same results as dealing items out one at a time
+        
+        for total in range(0, 30):
+            for columns in range(1, 7):
+                items = range(0, total)
+                self.assertEqual(columnize(items, columns), [[item for item in items if item % columns == column] for column in range(columns)])
+                self.assertEqual(sum(columnize(items, columns, stacked=True), []), items)
+    
+    def test_chunk_and_grid(self):
+        
+        items = range(1, 8)
+        
+        self.assertEqual(chunk(items, 3), [[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual(chunk([], 3), [])
+        self.assertEqual(grid(items, 3), [[1, 2, 3], [4, 5, 6], [7, None, None]])
+        self.assertEqual(grid(items, 3, stacked=True, fill=''), [[1, 4, 6], [2, 5, 7], [3, '', '']])
+        self.assertEqual(items, range(1, 8), "Source list was modified")
+
+class MemoizeTestCase(TestCase):
+    
+    """
+    Test case for memoize.py
+    """
+    
+    def test_lru_cache(self):
+        
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        
+        self.assertEqual(cache.get('a'), 1)
+        
+        cache.set('c', 3) # Evicts 'b', the least recently used
+        
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+        
+        # Disabled
+        
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+    
+    def test_memoize(self):
+        
+        calls = []
+        cache = LRUCache(10)
+        
+        @memoize(cache)
+        def words(value, character=' '):
+            calls.append(value)
+            return value.split(character)
+        
+        self.assertEqual(words('hey there dude'), ['hey', 'there', 'dude'])
+        
+        result = words('hey there dude')
+        result.append('changed')
+        
+        self.assertEqual(words('hey there dude'), ['hey', 'there', 'dude'], "Cached list was modified")
+        self.assertEqual(words('hey,there', ','), ['hey', 'there'])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+class TwitterTestCase(TestCase):
+    
+    """
+    Test case for twitter.py, against a local stand-in for the Twitter API
+    """
+    
+    tweets = '[{"id": 2, "text": "Second", "created_at": "Thu Dec 22 19:30:11 +0000 2011"}, {"id": 1, "text": "First", "created_at": "Wed Dec 21 08:00:00 +0000 2011"}]'
+    
+    def setUp(self):
+        self.server = StandInServer({'/statuses/user_timeline.json': (200, self.tweets)})
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_get_tweets(self):
+        
+        client = TwitterClient(self.server.url)
+        tweets = client.get_tweets('cubancouncil', count=2)
+        
+        self.assertEqual([tweet['text'] for tweet in tweets], ['Second', 'First'])
+        self.assertEqual(tweets[0]['created_at'], datetime(2011, 12, 22, 19, 30, 11))
+        self.assertEqual(self.server.requests, ['/statuses/user_timeline.json?count=2&screen_name=cubancouncil'])
+        
+        # Cached
+        
+        self.assertEqual(client.get_tweets('cubancouncil', count=2), tweets)
+        self.assertEqual(len(self.server.requests), 1)
+        
+        # Errors return None
+        
+        self.assertEqual(TwitterClient(self.server.url + 'missing/').get_tweets('cubancouncil'), None)
+    
+    def test_stale_while_revalidate(self):
+        
+        client = TwitterClient(self.server.url, cache_timeout=60)
+        cache_key = client.get_cache_key('cubancouncil', {})
+        
+        # Serve a stale copy straight away and refresh it in the background
+        
+        cache.set(cache_key, (time.time() - 120, ['stale'],), 600)
+        
+        self.assertEqual(client.get_tweets('cubancouncil'), ['stale'])
+        
+        for i in range(0, 50):
+            if cache.get(cache_key)[1] != ['stale']:
+                break
+            time.sleep(0.05)
+        
+        self.assertEqual(len(client.get_tweets('cubancouncil')), 2, "Stale timeline was not refreshed")
+        self.assertEqual(len(self.server.requests), 1)
+    
+    def test_get_many(self):
+        
+        client = TwitterClient(self.server.url, cache_timeout=0)
+        timelines = client.get_many(['one', 'two', 'three', 'one'])
+        
+        self.assertEqual(sorted(timelines.keys()), ['one', 'three', 'two'])
+        self.assertEqual([len(tweets) for tweets in timelines.values()], [2, 2, 2])
+        self.assertEqual(len(self.server.requests), 3)
+    
+    def test_parse_tweets(self):
+        
+        self.assertEqual(parse_created_at('Thu Dec 22 19:30:11 +0000 2011'), datetime(2011, 12, 22, 19, 30, 11))
+        self.assertEqual(parse_created_at('Thu Dec 22 19:30:11 -0130 2011'), datetime(2011, 12, 22, 21, 0, 11))
+        self.assertRaises(ValueError, parse_created_at, 'Thu Foo 22 19:30:11 +0000 2011')
+        self.assertRaises(ValueError, parse_created_at, '2011-12-22 19:30:11')
+        
+        # Compact records
+        
+        client = TwitterClient(self.server.url, tweet_class=Tweet)
+        tweets = client.get_tweets('cubancouncil')
+        
+        self.assertEqual([tweet.text for tweet in tweets], ['Second', 'First'])
+        self.assertEqual(tweets[0]['created_at'], datetime(2011, 12, 22, 19, 30, 11))
+        self.assertEqual(tweets[0].get('retweet_count'), None)
+        self.assertEqual(pickle.loads(pickle.dumps(tweets, 0)), tweets)
+        self.assertEqual(Template('{{ tweet.text }}').render(Context({'tweet': tweets[0]})), 'Second')
+        
+        tweet = Tweet({'id': 3, 'text': 'Third', 'lang': 'en'})
+        
+        self.assertEqual(tweet['lang'], 'en')
+        self.assertRaises(KeyError, lambda: tweet['missing'])
+    
+    def test_refresher(self):
+        
+        client = TwitterClient(self.server.url)
+        refresher = TwitterRefresher(['one', 'two', ('three', {'count': 2})], batch_size=2, client=client)
+        
+        self.assertEqual(client.get_cached('one'), None)
+        self.assertEqual(refresher.refresh(), 0)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual('/statuses/user_timeline.json?count=2&screen_name=three' in self.server.requests, True)
+        
+        # Warm timelines are read from the cache without any requests
+        
+        self.assertEqual(len(client.get_cached('one')), 2)
+        self.assertEqual(len(client.get_cached('three', count=2)), 2)
+        self.assertEqual(client.get_cached('three'), None)
+        self.assertEqual(len(self.server.requests), 3)
+        
+        # Runs until stopped
+        
+        refresher.interval = 0.01
+        refresher.start()
+        
+        for i in range(0, 50):
+            if len(self.server.requests) >= 9:
+                break
+            time.sleep(0.05)
+        
+        refresher.stop()
+        refresher.join(5)
+        
+        self.assertEqual(refresher.is_alive(), False)
+        self.assertEqual(len(self.server.requests) >= 9, True, "Timelines weren't refreshed in the background")
+        
+        # Failures are counted
+        
+        refresher = TwitterRefresher(['one'], client=TwitterClient(self.server.url + 'missing/'))
+        self.assertEqual(refresher.refresh(), 1)
+
 class WindowPaginatorTestCase(TestCase):
     
     """
@@ -126,6 +753,670 @@ class WindowPaginatorTestCase(TestCase):
                     self.assertIsInstance(page, WindowPage, 'Instance is not a `WindowPage` object')
                     self.assertEqual(page.page_range, test[1], 'Window %d, page %d page range incorrect' % (window, num))
 
+    def test_keyset_paginator(self):
+        
+        for i in range(0, 23):
+            Article.objects.create(title='Article %d' % i)
+        
+        pager = WindowPaginator(Article.objects.all(), 5, key='pk') # 23 objects, 5 pages
+        
+        # Walk forward through every page by following cursors
+        
+        page = pager.cursor_page(window=3)
+        titles = []
+        numbers = []
+        
+        while True:
+            self.assertIsInstance(page, WindowPage)
+            titles.extend([article.title for article in page.object_list])
+            numbers.append(page.number)
+            if not page.has_next():
+                break
+            page = pager.cursor_page(page.next_cursor, window=3)
+        
+        self.assertEqual(titles, ['Article %d' % i for i in range(0, 23)], 'Keyset pages did not cover every object in order')
+        self.assertEqual(numbers, [1, 2, 3, 4, 5], 'Keyset page numbers incorrect')
+        self.assertEqual(page.next_cursor, None, 'Last keyset page should not have a next cursor')
+        self.assertEqual(page.page_range, [1, 2, 3, 4, 5], 'Keyset page range incorrect')
+        
+        # ...and back again
+        
+        page = pager.cursor_page(page.previous_cursor)
+        self.assertEqual(page.number, 4)
+        self.assertEqual([article.title for article in page.object_list], ['Article %d' % i for i in range(15, 20)], 'Previous keyset page incorrect')
+        self.assertTrue(page.has_next())
+        
+        # Cursors generated from numbered pages
+        
+        page = pager.cursor_page(pager.page(2).next_cursor)
+        self.assertEqual(page.number, 3)
+        self.assertEqual(page.object_list[0].title, 'Article 10', 'Cursor from numbered page incorrect')
+        
+        # Bogus cursors
+        
+        self.assertRaises(InvalidPage, pager.cursor_page, 'not-a-cursor')
+    
+    def test_keyset_paginator_descending(self):
+        
+        for i in range(0, 12):
+            Article.objects.create(title='Article %d' % i)
+        
+        # All objects share the same 'created' value, so the pk tie-breaker does the work
+        
+        Article.objects.update(created=Article.objects.all()[0].created)
+        
+        pager = WindowPaginator(Article.objects.all(), 5, orphans=2, key='-created')
+        page = pager.cursor_page()
+        self.assertEqual([article.title for article in page.object_list], ['Article %d' % i for i in range(11, 6, -1)])
+        
+        page = pager.cursor_page(page.next_cursor)
+        self.assertEqual([article.title for article in page.object_list], ['Article %d' % i for i in range(6, -1, -1)], 'Keyset orphans were not included in the last page')
+        self.assertFalse(page.has_next())
+    
+    def test_count_strategies(self):
+        
+        for i in range(0, 12):
+            Article.objects.create(title='Article %d' % i)
+        
+        # Cached counts stick around until they expire
+        
+        pager = WindowPaginator(Article.objects.all(), 5, count_strategy=CachedCount())
+        self.assertEqual(pager.count, 12)
+        
+        Article.objects.create(title='Article 12')
+        
+        pager = WindowPaginator(Article.objects.all(), 5, count_strategy=CachedCount())
+        self.assertEqual(pager.count, 12, 'Cached count was not used')
+        
+        pager = WindowPaginator(Article.objects.filter(title__startswith='Article'), 5, count_strategy=CachedCount())
+        self.assertEqual(pager.count, 13, 'Cached count is not keyed by query')
+        
+        # Approximate counts fall back to an exact count for small or unsupported tables
+        
+        pager = WindowPaginator(Article.objects.all(), 5, count_strategy=ApproximateCount())
+        self.assertEqual(pager.count, 13)
+        
+        # No count
+        
+        pager = WindowPaginator(Article.objects.all(), 3, count_strategy=NoCount())
+        self.assertEqual(pager.num_pages, None)
+        
+        test_sets = (
+            (1, None, [1, 2, None]),
+            (2, None, [1, 2, 3, None]),
+            (4, 3, [1, None, 3, 4, 5, None]),
+            (4, None, [1, 2, 3, 4, 5, None]),
+            (5, 3, [1, 2, 3, 4, 5]), # The last page knows the count, so the range is complete
+        )
+        
+        for num, window, page_range in test_sets:
+            page = pager.page(num, window=window)
+            self.assertEqual(page.page_range, page_range, 'No count page %d page range incorrect' % num)
+        
+        page = pager.page(5)
+        self.assertFalse(page.has_next())
+        self.assertEqual([article.title for article in page.object_list], ['Article 12'])
+        self.assertEqual((page.start_index(), page.end_index()), (13, 13))
+        self.assertRaises(InvalidPage, pager.page, 6)
+    
+    def test_lookahead(self):
+        
+        for i in range(0, 12):
+            Article.objects.create(title='Article %d' % i)
+        
+        # A page with a next page takes a single query, no count
+        
+        pager = WindowPaginator(Article.objects.order_by('pk'), 5, orphans=2, lookahead=True)
+        
+        with self.assertNumQueries(1):
+            page = pager.page(1)
+            self.assertEqual(len(page.object_list), 5)
+            self.assertTrue(page.has_next())
+            self.assertFalse(page.has_previous())
+        
+        # Count is deferred until the page range needs it
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(page.page_range, [1, 2])
+        
+        # The last page picks up orphans and works out the count without a COUNT query
+        
+        pager = WindowPaginator(Article.objects.order_by('pk'), 5, orphans=2, lookahead=True)
+        
+        with self.assertNumQueries(1):
+            page = pager.page(2)
+            self.assertEqual([article.title for article in page.object_list], ['Article %d' % i for i in range(5, 12)])
+            self.assertFalse(page.has_next())
+            self.assertEqual(pager.count, 12)
+        
+        # Page 3 would only hold orphans that page 2 already took in
+        
+        self.assertRaises(InvalidPage, pager.page, 3)
+
+# ---- MODELS, ADMIN AND AUTH
+
+class GlobalModelTestCase(TestCase):
+    
+    """
+    Test case for models.py
+    """
+    
+    def test_get_published_recent(self):
+        
+        first = Article.objects.create(title='First')
+        Article.objects.create(title='Draft', status=STATUS_DRAFT)
+        second = Article.objects.create(title='Second')
+        Article.objects.filter(pk=second.pk).update(created=first.created)
+        
+        self.assertEqual(list(Article.objects.get_published_recent()), [second, first])
+        self.assertEqual(list(Article.objects.filter(title='First').get_published_recent()), [first])
+    
+    def test_cached(self):
+        
+        cache.clear()
+        reset_cache_stats()
+        first = Article.objects.create(title='First')
+        second = Article.objects.create(title='Second')
+        Article.objects.filter(pk=second.pk).update(created=datetime(2011, 1, 1))
+        
+        self.assertNumQueries(1, lambda: self.assertEqual(list(Article.objects.get_published_recent().cached()), [first, second]))
+        self.assertNumQueries(0, lambda: self.assertEqual(list(Article.objects.get_published_recent().cached()), [first, second]))
+        self.assertNumQueries(1, lambda: self.assertEqual(Article.objects.get_published().cached().get(pk=first.pk), first))
+        self.assertNumQueries(0, lambda: self.assertEqual(Article.objects.get_published().cached().get(pk=first.pk), first))
+        self.assertNumQueries(2, lambda: list(Article.objects.get_published_recent().cached()[:1]) + list(Article.objects.get_published_recent()))
+        
+        # Primary key lists are cached, the rows are fetched by primary key
+        
+        self.assertNumQueries(1, lambda: list(Article.objects.get_published_recent().cached(pks=True)))
+        self.assertNumQueries(1, lambda: self.assertEqual(list(Article.objects.get_published_recent().cached(pks=True)[:1]), [first]))
+        self.assertNumQueries(1, lambda: self.assertEqual(list(Article.objects.get_published_recent().cached(pks=True)[:1]), [first]))
+        
+        # Saves, update() (and so admin actions), bulk helpers and deletes all invalidate
+        
+        first.title = 'Changed'
+        first.save()
+        self.assertEqual(Article.objects.get_published_recent().cached()[0].title, 'Changed')
+        
+        make_draft(AdminActionsTestCase.ModelAdmin(), None, Article.objects.filter(pk=first.pk))
+        self.assertEqual(list(Article.objects.get_published_recent().cached()), [second])
+        
+        Article.objects.bulk_insert([Article(title='Third', created=datetime(2010, 1, 1))])
+        self.assertEqual(len(Article.objects.get_published_recent().cached()), 2)
+        
+        second.delete()
+        self.assertEqual([article.title for article in Article.objects.get_published_recent().cached(pks=True)], ['Third'])
+        
+        stats = get_cache_stats(Article)
+        self.assertEqual((stats['hits'], stats['misses'],), (3, 9))
+        self.assertEqual(stats['invalidations'], 7)
+        self.assertEqual(get_cache_stats()['hit_rate'], 0.25)
+        
+        # values() and the like don't cache, so they refuse to, but work as subqueries
+        
+        self.assertRaises(ValueError, Article.objects.cached().values_list, 'pk')
+        self.assertRaises(ValueError, Article.objects.cached().values)
+        self.assertEqual(list(Article.objects.filter(pk__in=Article.objects.filter(title='Third').cached())), list(Article.objects.filter(title='Third')))
+        
+        settings.MACHETE_QUERYSET_CACHE_TIMEOUT = 0
+        self.assertNumQueries(1, lambda: list(Article.objects.get_published_recent().cached()))
+        del settings.MACHETE_QUERYSET_CACHE_TIMEOUT
+    
+    def test_cached_writes(self):
+        
+        cache.clear()
+        articles = [Article.objects.create(title='Article %d' % i, status=STATUS_DRAFT) for i in range(0, 3)]
+        
+        # Changes another process made don't reach this one's cache
+        
+        list(Article.objects.cached().filter(status=STATUS_DRAFT))
+        list(Article.objects.cached().changes())
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET status = %%s WHERE id = %%s' % Article._meta.db_table, [STATUS_PUBLISHED, articles[0].pk])
+        cursor.execute('DELETE FROM %s WHERE id = %%s' % Article._meta.db_table, [articles[1].pk])
+        
+        self.assertEqual(list(Article.objects.cached().changes()), [articles[0], articles[2]])
+        
+        Article.objects.cached().filter(status=STATUS_DRAFT).delete()
+        
+        self.assertEqual(list(Article.objects.all()), [articles[0]])
+    
+    def test_touch(self):
+        
+        article = Article.objects.create(title='First')
+        
+        # update() leaves 'modified' alone, touch() stamps it unless it's passed explicitly
+        
+        Article.objects.filter(pk=article.pk).update(modified=datetime(2011, 1, 1))
+        self.assertEqual(Article.objects.get(pk=article.pk).modified, datetime(2011, 1, 1))
+        
+        Article.objects.filter(pk=article.pk).update(title='Changed')
+        self.assertEqual(Article.objects.get(pk=article.pk).modified, datetime(2011, 1, 1))
+        
+        Article.objects.filter(pk=article.pk).touch(modified=datetime(2011, 1, 2))
+        self.assertEqual(Article.objects.get(pk=article.pk).modified, datetime(2011, 1, 2))
+        
+        Article.objects.filter(pk=article.pk).touch(title='Touched')
+        self.assertEqual(Article.objects.get(pk=article.pk).modified > datetime(2011, 1, 2), True)
+    
+    def test_changes(self):
+        
+        Article.objects.bulk_insert([Article(title='Article %d' % i) for i in range(0, 7)])
+        articles = list(Article.objects.order_by('pk'))
+        
+        # Same timestamps for some, to check the pk tie-breaker
+        
+        Article.objects.filter(pk__in=[article.pk for article in articles[:4]]).update(modified=datetime(2011, 1, 1))
+        Article.objects.filter(pk__in=[article.pk for article in articles[4:]]).update(modified=datetime(2011, 1, 2))
+        
+        changes = []
+        self.assertNumQueries(4, lambda: changes.extend(Article.objects.changes(batch_size=2)))
+        self.assertEqual([article.pk for article in changes], [article.pk for article in articles])
+        
+        # Pick up after the watermark, with status changes
+        
+        watermark = load_watermark(dump_watermark(get_watermark(changes[4])))
+        update_status(Article.objects.filter(pk=articles[1].pk), STATUS_DRAFT)
+        
+        self.assertEqual([article.pk for article in Article.objects.changes(watermark, batch_size=2)], [articles[5].pk, articles[6].pk, articles[1].pk])
+        self.assertEqual(list(Article.objects.changes(watermark, until=datetime(2011, 1, 3))), [articles[5], articles[6]])
+        self.assertEqual([article.status for article in Article.objects.changes(watermark)][-1], STATUS_DRAFT)
+    
+    def test_bulk_insert(self):
+        
+        articles = [Article(title='Article %d' % i) for i in range(0, 30)]
+        articles[0].created = datetime(2011, 1, 1)
+        articles[1].status = None
+        articles[2].status = STATUS_DRAFT
+        
+        self.assertNumQueries(5, lambda: self.assertEqual(Article.objects.bulk_insert(articles, batch_size=7), 30))
+        self.assertEqual(Article.objects.count(), 30)
+        self.assertEqual(Article.objects.get_published().count(), 29)
+        self.assertEqual(Article.objects.filter(created__isnull=True).count() + Article.objects.filter(modified__isnull=True).count(), 0)
+        self.assertEqual(Article.objects.get(title='Article 0').created, datetime(2011, 1, 1))
+        self.assertEqual(Article.objects.bulk_insert([]), 0)
+    
+    def test_bulk_update(self):
+        
+        Article.objects.bulk_insert([Article(title='Article %d' % i) for i in range(0, 10)])
+        Article.objects.update(modified=datetime(2011, 1, 1))
+        articles = list(Article.objects.order_by('pk'))
+        
+        for i, article in enumerate(articles):
+            article.title = 'Changed %d' % i
+            article.status = i % 2
+        
+        self.assertNumQueries(3, lambda: self.assertEqual(Article.objects.bulk_update(articles, ['title', 'status'], batch_size=4), 10))
+        self.assertEqual([(article.title, article.status) for article in Article.objects.order_by('pk')], [('Changed %d' % i, i % 2) for i in range(0, 10)])
+        self.assertEqual(Article.objects.filter(modified=datetime(2011, 1, 1)).count(), 0)
+        self.assertEqual(Article.objects.filter(created=datetime(2011, 1, 1)).count(), 0)
+    
+    def test_upsert(self):
+        
+        first = Article.objects.create(title='First', status=STATUS_DRAFT)
+        created = Article.objects.get(pk=first.pk).created
+        articles = [Article(title='First'), Article(title='Second')]
+        
+        self.assertEqual(Article.objects.upsert(articles, 'title'), (1, 1))
+        self.assertEqual(articles[0].pk, first.pk)
+        self.assertEqual(Article.objects.get(pk=first.pk).status, STATUS_DRAFT)
+        self.assertEqual(Article.objects.get(pk=first.pk).created, created)
+        
+        # Status is only updated when asked for
+        
+        self.assertEqual(Article.objects.upsert([Article(title='First')], 'title', ['title', 'status']), (0, 1))
+        self.assertEqual(Article.objects.get(pk=first.pk).status, STATUS_PUBLISHED)
+        self.assertEqual(Article.objects.upsert([Article(title='Second'), Article(title='Third')], ['title', 'status']), (1, 1))
+        self.assertEqual(Article.objects.count(), 3)
+    
+    def test_upsert_batches(self):
+        
+        # More rows than fit in one lookup with a composite key
+        
+        Article.objects.bulk_insert([Article(title='Article %d' % i) for i in range(0, 600)])
+        articles = [Article(title='Article %d' % i, status=STATUS_PUBLISHED) for i in range(0, 650)]
+        
+        self.assertEqual(Article.objects.upsert(articles, ['title', 'status']), (50, 600))
+        self.assertEqual(Article.objects.count(), 650)
+    
+    def test_upsert_foreign_key(self):
+        
+        portland = Place.objects.create(name='Portland')
+        seattle = Place.objects.create(name='Seattle')
+        Listing.objects.create(place=portland, title='Old')
+        
+        self.assertEqual(Listing.objects.upsert([Listing(place=portland, title='New'), Listing(place=seattle, title='New')], 'place'), (1, 1))
+        self.assertEqual(Listing.objects.upsert([Listing(place=seattle, title='New'), Listing(place=seattle, title='Newer')], ['place', 'title']), (1, 1))
+        self.assertEqual(sorted(Listing.objects.values_list('place__name', 'title')), [(u'Portland', u'New'), (u'Seattle', u'New'), (u'Seattle', u'Newer')])
+
+class PublishedIndexesTestCase(TransactionTestCase):
+    
+    """
+    Test case for indexes.py, a TransactionTestCase since creating indexes commits
+    """
+    
+    def test_published_indexes(self):
+        
+        self.assertEqual(get_published_index_sql(Article), [
+            'CREATE INDEX "machete_article_status_created" ON "machete_article" ("status", "created", "id")',
+            'CREATE INDEX "machete_article_published_created" ON "machete_article" ("created", "id") WHERE "status" = 1',
+            'CREATE INDEX "machete_article_modified" ON "machete_article" ("modified", "id")',
+        ])
+        
+        create_published_indexes(Article)
+        
+        try:
+            plan = explain(Article.objects.get_published_recent().values_list('pk'))
+            self.assertEqual('machete_article_published_created' in plan or 'machete_article_status_created' in plan, True, plan)
+            self.assertEqual('TEMP B-TREE' in plan, False, "Query sorts instead of reading the index in order: %s" % plan)
+        finally:
+            drop_published_indexes(Article)
+    
+    def test_keyset_paginator_plan(self):
+        
+        create_published_indexes(Article)
+        
+        try:
+            for key in ('-modified', 'modified'):
+                pager = WindowPaginator(Article.objects.all(), 5, key=key)
+                for previous in (False, True):
+                    queryset = pager.object_list.filter(pager._get_key_filter([datetime(2011, 1, 1), 10], previous)).order_by(*pager._get_key_ordering())
+                    plan = explain(queryset)
+                    self.assertEqual('SEARCH' in plan and 'machete_article_modified' in plan, True, "Cursor isn't looked up in the index: %s" % plan)
+        finally:
+            drop_published_indexes(Article)
+    
+    def test_changes_plan(self):
+        
+        create_published_indexes(Article)
+        
+        try:
+            plan = explain(Article.objects.order_by('modified', 'pk').filter(get_watermark_filter((datetime(2011, 1, 1), 10,))))
+            self.assertEqual('SEARCH' in plan and 'machete_article_modified' in plan, True, "Watermark isn't looked up in the index: %s" % plan)
+        finally:
+            drop_published_indexes(Article)
+
+class AdminActionsTestCase(TestCase):
+    
+    """
+    Test case for admin.py
+    """
+    
+    class ModelAdmin(object):
+        
+        def __init__(self):
+            self.messages = []
+        
+        def message_user(self, request, message):
+            self.messages.append(message)
+    
+    def setUp(self):
+        for i in range(0, 25):
+            Article.objects.create(title='Article %d' % i, status=STATUS_PUBLISHED if i % 5 else STATUS_DRAFT)
+    
+    def test_update_status(self):
+        
+        progress = []
+        
+        # 20 published rows to update, in batches of 8, plus the query finding there's nothing left
+        
+        self.assertNumQueries(3 * 2 + 1, lambda: self.assertEqual(update_status(Article.objects.all(), STATUS_DRAFT, 8, progress.append), 20))
+        self.assertEqual(progress, [8, 16, 20])
+        self.assertEqual(Article.objects.filter(status=STATUS_DRAFT).count(), 25)
+        
+        # Nothing to do
+        
+        self.assertNumQueries(1, lambda: self.assertEqual(update_status(Article.objects.all(), STATUS_DRAFT, 8), 0))
+    
+    def test_actions(self):
+        
+        modeladmin = self.ModelAdmin()
+        make_published(modeladmin, None, Article.objects.filter(title__in=['Article 0', 'Article 1']))
+        make_draft(modeladmin, None, Article.objects.all())
+        
+        self.assertEqual(modeladmin.messages, ['1 items marked as published', '21 items marked as draft'])
+        self.assertEqual(Article.objects.get_published().count(), 0)
+    
+    def test_background_job(self):
+        
+        modeladmin = self.ModelAdmin()
+        settings.MACHETE_ADMIN_BACKGROUND_THRESHOLD = 10
+        
+        # Run the job in this thread, since the test database isn't shared between connections
+        
+        start = StatusJob.start
+        StatusJob.start = lambda self: None
+        
+        try:
+            job = set_status(modeladmin, None, Article.objects.all(), STATUS_DRAFT, 'draft')
+        finally:
+            StatusJob.start = start
+            del settings.MACHETE_ADMIN_BACKGROUND_THRESHOLD
+        
+        self.assertEqual(modeladmin.messages, ['Marking 25 items as draft in the background (job %s)' % job.job_id])
+        self.assertEqual(get_job_progress(job.job_id), {'total': 25, 'updated': 0, 'done': False})
+        
+        job.process()
+        
+        self.assertEqual(get_job_progress(job.job_id), {'total': 25, 'updated': 20, 'done': True})
+        self.assertEqual(Article.objects.get_published().count(), 0)
+
+class AdminTransactionsTestCase(TransactionTestCase):
+    
+    """
+    Test case for admin.py batches under a managed transaction
+    """
+    
+    def test_update_status_commits_batches(self):
+        
+        for i in range(0, 5):
+            Article.objects.create(title='Article %d' % i)
+        
+        # Batches survive the caller rolling back only when asked to commit, which isn't the default
+        
+        @transaction.commit_manually
+        def update(**kwargs):
+            update_status(Article.objects.all(), STATUS_DRAFT, 2, **kwargs)
+            transaction.rollback()
+        
+        update()
+        self.assertEqual(Article.objects.filter(status=STATUS_DRAFT).count(), 0)
+        
+        update(commit=False)
+        self.assertEqual(Article.objects.filter(status=STATUS_DRAFT).count(), 0)
+        
+        update(commit=True)
+        self.assertEqual(Article.objects.filter(status=STATUS_DRAFT).count(), 5)
+
+class ModelBackendFlexibleTestCase(TestCase):
+    
+    """
+    Test case for auth/backends.py
+    """
+    
+    def setUp(self):
+        cache.clear()
+        self.backend = ModelBackendFlexible()
+        self.user = User.objects.create_user('jerry', 'Jerry@Example.com', 'secret')
+    
+    def test_authenticate(self):
+        
+        self.assertEqual(self.backend.authenticate('jerry', 'secret'), self.user)
+        self.assertEqual(self.backend.authenticate('jerry@example.com', 'secret'), self.user)
+        self.assertEqual(self.backend.authenticate('JERRY@EXAMPLE.COM', 'secret'), self.user)
+        self.assertEqual(self.backend.authenticate('jerry', 'wrong'), None)
+        self.assertEqual(self.backend.authenticate('elaine', 'secret'), None)
+        self.assertEqual(self.backend.authenticate(None, 'secret'), None)
+        
+        # Failed logins only take one query
+        
+        self.assertNumQueries(1, lambda: self.backend.authenticate('jerry@example.com', 'wrong'))
+        self.assertNumQueries(1, lambda: self.backend.authenticate('jerry', 'wrong'))
+    
+    def test_username_with_at_sign(self):
+        user = User.objects.create_user('kramer@home', 'kramer@example.com', 'giddyup')
+        self.assertEqual(self.backend.authenticate('kramer@home', 'giddyup'), user)
+    
+    def test_duplicate_emails(self):
+        user = User.objects.create_user('jerry2', 'jerry@example.com', 'other')
+        self.assertEqual(self.backend.authenticate('jerry@example.com', 'secret'), self.user)
+        self.assertEqual(self.backend.authenticate('jerry@example.com', 'other'), user)
+    
+    def test_legacy_password(self):
+        
+        User.objects.filter(pk=self.user.pk).update(password=md5_constructor('old').hexdigest())
+        
+        self.assertEqual(self.backend.authenticate('jerry', 'old'), self.user)
+        self.assertEqual('$' in User.objects.get(pk=self.user.pk).password, True, "Password wasn't converted")
+        self.assertEqual(self.backend.authenticate('jerry', 'old'), self.user)
+    
+    def test_rehash(self):
+        
+        self.assertEqual(needs_rehash(self.user.password), False)
+        self.assertEqual(needs_rehash('md5$abc$%s' % md5_constructor('abcold').hexdigest()), True)
+        self.assertEqual(needs_rehash('!'), False)
+        
+        User.objects.filter(pk=self.user.pk).update(password='md5$abc$%s' % md5_constructor('abcold').hexdigest())
+        
+        self.assertEqual(self.backend.authenticate('jerry', 'old'), self.user)
+        self.assertEqual(User.objects.get(pk=self.user.pk).password.startswith('sha1$'), True, "Password wasn't rehashed")
+        self.assertEqual(self.backend.authenticate('jerry', 'old'), self.user)
+    
+    def test_password_verifier(self):
+        
+        verifier = PasswordVerifier(2)
+        results = []
+        
+        try:
+            self.assertEqual(verifier.verify('secret', self.user.password), True)
+            self.assertEqual(verifier.verify('wrong', self.user.password), False)
+            verifier.verify_async('secret', self.user.password, results.append).get(5)
+            self.assertEqual(results, [True])
+            
+            # Used by the backend
+            
+            settings.MACHETE_AUTH_PASSWORD_WORKERS = 2
+            self.assertEqual(self.backend.authenticate('jerry', 'secret'), self.user)
+            self.assertEqual(self.backend.authenticate('jerry', 'wrong'), None)
+        finally:
+            verifier.close()
+            settings.MACHETE_AUTH_PASSWORD_WORKERS = 0
+            if backends.password_verifier is not None:
+                backends.password_verifier.close()
+    
+    def test_login_cache(self):
+        
+        # Unknown logins don't go back to the database
+        
+        self.assertNumQueries(1, lambda: self.backend.authenticate('elaine', 'secret'))
+        self.assertNumQueries(0, lambda: self.backend.authenticate('elaine', 'secret'))
+        
+        # Until the user's created
+        
+        user = User.objects.create_user('elaine', 'elaine@example.com', 'secret')
+        
+        self.assertEqual(self.backend.authenticate('elaine', 'secret'), user)
+        
+        # Known logins are looked up by primary key
+        
+        self.assertEqual(self.backend.authenticate('jerry@example.com', 'wrong'), None)
+        self.assertNumQueries(1, lambda: self.backend.authenticate('jerry@example.com', 'wrong'))
+        
+        # Changed emails are picked up
+        
+        self.user.email = 'jerry@seinfeld.com'
+        self.user.save()
+        
+        self.assertEqual(self.backend.authenticate('jerry@example.com', 'secret'), None)
+        self.assertEqual(self.backend.authenticate('jerry@seinfeld.com', 'secret'), self.user)
+    
+    def test_login_cache_case(self):
+        
+        # Email-style logins are cached and cleared whatever their case
+        
+        self.assertEqual(self.backend.authenticate('Jerry@Example.com', 'wrong'), None)
+        self.assertNotEqual(cache.get(get_cache_key('login', 'jerry@example.com')), None)
+        
+        self.user.email = 'jerry@seinfeld.com'
+        self.user.save()
+        
+        self.assertEqual(cache.get(get_cache_key('login', 'jerry@example.com')), None)
+        
+        # An unknown login doesn't hide a username that differs only in case
+        
+        user = User.objects.create_user('kramer@home', 'kramer@example.com', 'giddyup')
+        
+        self.assertEqual(self.backend.authenticate('Kramer@Home', 'giddyup'), None)
+        self.assertEqual(self.backend.authenticate('kramer@home', 'giddyup'), user)
+    
+    def test_attempt_limit(self):
+        
+        for i in range(0, self.backend.max_attempts):
+            self.assertEqual(self.backend.authenticate('Jerry', 'wrong'), None)
+        
+        self.assertEqual(cache.get(get_cache_key('attempts', 'jerry')), self.backend.max_attempts)
+        
+        # Locked out, without so much as a query
+        
+        self.assertNumQueries(0, lambda: self.backend.authenticate('jerry', 'secret'))
+        self.assertEqual(self.backend.authenticate('jerry', 'secret'), None)
+        
+        # A successful login resets the count
+        
+        cache.delete(get_cache_key('attempts', 'jerry'))
+        self.backend.authenticate('jerry', 'wrong')
+        
+        self.assertEqual(self.backend.authenticate('jerry', 'secret'), self.user)
+        self.assertEqual(cache.get(get_cache_key('attempts', 'jerry')), None)
+        
+        # The count starts over once the window from the first failure has passed, whatever
+        # the cache does with the count's own expiry
+        
+        for i in range(0, self.backend.max_attempts):
+            self.backend.authenticate('jerry', 'wrong')
+        
+        self.assertEqual(self.backend.authenticate('jerry', 'secret'), None)
+        
+        cache.set(get_cache_key('attempts_started', 'jerry'), time.time() - self.backend.attempt_timeout)
+        
+        self.assertEqual(self.backend.authenticate('jerry', 'secret'), self.user)
+    
+    def test_get_user(self):
+        
+        self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        self.assertNumQueries(0, lambda: self.backend.get_user(self.user.pk))
+        
+        self.user.first_name = 'Jerry'
+        self.user.save()
+        
+        self.assertEqual(self.backend.get_user(self.user.pk).first_name, 'Jerry')
+        
+        self.user.delete()
+        
+        self.assertEqual(self.backend.get_user(self.user.pk), None)
+
+class EmailIndexTestCase(TransactionTestCase):
+    
+    """
+    Test case for auth/indexes.py, a TransactionTestCase since creating indexes commits
+    """
+    
+    def test_email_index(self):
+        
+        cache.clear()
+        user = User.objects.create_user('jerry', 'Jerry@Example.com', 'secret')
+        
+        self.assertEqual(get_email_index_sql(), 'CREATE INDEX "auth_user_email_ci" ON "auth_user" ("email" COLLATE NOCASE)')
+        
+        create_email_index()
+        
+        try:
+            plan = explain(filter_email(User.objects.values_list('pk', 'password'), 'jerry@example.com').order_by('pk'))
+            self.assertEqual('auth_user_email_ci' in plan, True, "Email lookup doesn't use the index: %s" % plan)
+            self.assertEqual(ModelBackendFlexible().authenticate('jerry@example.com', 'secret'), user)
+            self.assertEqual(list(filter_email(User.objects.all(), 'JERRY@example.COM')), [user])
+        finally:
+            drop_email_index()
+
 # ---- TEMPLATE TAGS
 
 class MacheteFiltersTestCase(BaseTestCase):
@@ -141,6 +1432,24 @@ class MacheteFiltersTestCase(BaseTestCase):
         odds = [1, 3, 5, 21.0, -7, '5']
         for num in odds:
             self.assertTrue(self.render_template('{{ num|odd }}', {'num': num}))
+    
+    def test_twitterize(self):
+        
+        tweet = 'Loving #django with @cubancouncil, see http://example.com/foo. (www.google.com)'
+        expected = 'Loving <a target="_blank" href="http://search.twitter.com/search?q=%23django">#django</a> with <a target="_blank" href="http://twitter.com/cubancouncil">@cubancouncil</a>, see <a target="_blank" href="http://example.com/foo">http://example.com/foo</a>. (<a target="_blank" href="http://www.google.com">www.google.com</a>)'
+        
+        self.assertEqual(self.render_template('{{ tweet|twitterize }}', {'tweet': tweet}), expected)
+        self.assertEqual(self.render_template('{{ tweet|twitterize }}', {'tweet': tweet}), expected, "Memoized twitterize output is incorrect")
+        self.assertEqual(twitterize_cache.stats()['hits'] >= 1, True)
+        
+        # The other filters aren't memoized unless MACHETE_FILTER_CACHE_SIZE is set
+        
+        self.render_template('{{ text|make_paragraphlist }}', {'text': tweet})
+        self.assertEqual(len(filter_cache), 0)
+        
+        # Only mentions and hashtags at the start of a word get linked
+        
+        self.assertEqual(self.render_template('{{ tweet|twitterize }}', {'tweet': 'me@home #1! email@example.com'}), 'me@home <a target="_blank" href="http://search.twitter.com/search?q=%231">#1</a>! <a target="_blank" href="mailto:email@example.com">email@example.com</a>')
         
 
 class QueryStringTagTestCase(BaseTestCase):
@@ -406,6 +1715,104 @@ class QueryStringTagTestCase(BaseTestCase):
 
         self.assertEqual(rendered[0], '?')
         self.assertEqual(parse_qs(rendered.lstrip('?')), parse_qs('&page=40&artists[]=50&artists[]=60&artists[]=70&title=Some+Title'), "Array remove non-existent query string test incorrect: %s, %s" % (qs, expr))
+    
+    def test_querystring_loop(self):
+        
+        # Every link in a loop shares the compiled base query string, which must not change
+        
+        qs = {'page': 2, 'artists[]': [50, 60], 'title': 'Some Title'}
+        expr = "{% for artist in artists %}{% querystring qs artists[]+=artist page=None %}|{% endfor %}"
+        rendered = self.render_template(
+            expr,
+            {'qs': qs, 'artists': [70, 80]}
+        )
+        
+        links = rendered.split('|')[:-1]
+        
+        self.assertEqual(len(links), 2)
+        self.assertEqual(parse_qs(links[0].lstrip('?')), parse_qs('artists[]=50&artists[]=60&artists[]=70&title=Some+Title'), "Looped query string incorrect: %s, %s" % (qs, expr))
+        self.assertEqual(parse_qs(links[1].lstrip('?')), parse_qs('artists[]=50&artists[]=60&artists[]=80&title=Some+Title'), "Looped query string incorrect: %s, %s" % (qs, expr))
+        self.assertEqual(qs, {'page': 2, 'artists[]': [50, 60], 'title': 'Some Title'}, "Base query string was modified")
+        
+        # Missing bases share one compiled empty query string
+        
+        context = Context({})
+        compiled = CompiledQueryString.for_context(context, None)
+        
+        self.assertEqual(CompiledQueryString.for_context(context, None) is compiled, True)
+        self.assertEqual(CompiledQueryString.for_context(context, '') is compiled, True)
+        self.assertEqual(len(context.render_context[CompiledQueryString.context_key]), 1)
+    
+    def test_querystring_literals(self):
+        
+        # Literal arguments are resolved and encoded when the template is compiled
+        
+        qs = {'page': 1, 'artists[]': [40]}
+        expr = "{% querystring qs year=2011 title='Some Title' artists[]+='50' page=None %}"
+        rendered = self.render_template(
+            expr,
+            {'qs': qs}
+        )
+        
+        self.assertEqual(parse_qs(rendered.lstrip('?')), parse_qs('year=2011&title=Some+Title&artists[]=40&artists[]=50'), "Literal arguments query string is incorrect: %s, %s" % (qs, expr))
+        
+        # Bad arguments are template syntax errors instead of being dropped silently
+        
+        self.assertRaises(TemplateSyntaxError, self.render_template, "{% querystring qs title=title|nonexistentfilter %}")
+
+class QueryStringsTagTestCase(BaseTestCase):
+    
+    """
+    Test case for 'querystrings' template tag
+    """
+    
+    default_template_string = '{% load machete %}'
+    
+    def test_for(self):
+        
+        qs = {'page': 3, 'sort': 'date'}
+        expr = "{% querystrings qs page=None for genre in genres as links %}"
+        rendered, context = self.render(
+            expr,
+            {'qs': qs, 'genres': ['rock', 'jazz']}
+        )
+        
+        self.assertEqual([link[0] for link in context['links']], ['rock', 'jazz'])
+        self.assertEqual(parse_qs(context['links'][0][1].lstrip('?')), parse_qs('sort=date&genre=rock'), "Batch query string is incorrect: %s, %s" % (qs, expr))
+        self.assertEqual(parse_qs(context['links'][1][1].lstrip('?')), parse_qs('sort=date&genre=jazz'), "Batch query string is incorrect: %s, %s" % (qs, expr))
+    
+    def test_for_array_append(self):
+        
+        qs = {'artists[]': [50]}
+        expr = "{% querystrings qs append for artists[]+ in artists as links %}"
+        rendered, context = self.render(
+            expr,
+            {'qs': qs, 'artists': [60, 70]}
+        )
+        
+        self.assertEqual(context['links'][0][1][0], '&')
+        self.assertEqual(parse_qs(context['links'][0][1].lstrip('&')), parse_qs('artists[]=50&artists[]=60'), "Batch array append query string is incorrect: %s, %s" % (qs, expr))
+        self.assertEqual(parse_qs(context['links'][1][1].lstrip('&')), parse_qs('artists[]=50&artists[]=70'), "Batch array append query string is incorrect: %s, %s" % (qs, expr))
+        self.assertEqual(qs, {'artists[]': [50]}, "Base query string was modified")
+    
+    def test_from(self):
+        
+        qs = {'page': 3}
+        overrides = [{'sort': 'date'}, {'sort': 'title', 'page': None}]
+        expr = "{% querystrings qs from overrides as links %}"
+        rendered, context = self.render(
+            expr,
+            {'qs': qs, 'overrides': overrides}
+        )
+        
+        self.assertEqual(context['links'][0][0], overrides[0])
+        self.assertEqual(parse_qs(context['links'][0][1].lstrip('?')), parse_qs('page=3&sort=date'), "Batch override query string is incorrect: %s, %s" % (qs, expr))
+        self.assertEqual(context['links'][1][1], '?sort=title', "Batch override query string is incorrect: %s, %s" % (qs, expr))
+    
+    def test_syntax(self):
+        
+        self.assertRaises(TemplateSyntaxError, self.render_template, "{% querystrings qs for genre in genres %}")
+        self.assertRaises(TemplateSyntaxError, self.render_template, "{% querystrings qs genres as links %}")
 
 class ColumnizeTagTestCase(BaseTestCase):
     
@@ -500,6 +1907,62 @@ class ColumnizeTagTestCase(BaseTestCase):
         
         self.assertEqual(len(context['testlist'][3]), 2, "The fourth column's length is incorrect")
         self.assertEqual(context['testlist'][3], ['dude', 'awesome'], "The fourth column was not sorted properly")
+        
+        # As many items as columns
+        
+        mylist = ['some', 'test', 'list']
+        expr = '{% columnize mylist into 3 stacked %}'
+        rendered, context = self.render(expr, {'mylist': mylist})
+        
+        self.assertEqual(context['mylist'], [['some'], ['test'], ['list']], "Stacked columns with as many items as columns were not sorted properly")
+    
+    def test_lazy_keyword(self):
+        
+        for i in range(0, 10):
+            Article.objects.create(title='Article %d' % i)
+        
+        articles = Article.objects.order_by('pk')
+        
+        # Stacked: one count query, then one query per column as it's used
+        
+        expr = '{% columnize articles into 3 stacked lazy as columns %}'
+        
+        with self.assertNumQueries(1):
+            rendered, context = self.render(expr, {'articles': articles})
+        
+        with self.assertNumQueries(3):
+            columns = [[article.title for article in column] for column in context['columns']]
+        
+        self.assertEqual(columns, [['Article 0', 'Article 1', 'Article 2', 'Article 3'], ['Article 4', 'Article 5', 'Article 6'], ['Article 7', 'Article 8', 'Article 9']], "Lazy stacked columns were not sorted properly")
+        
+        # Columns don't hold on to their rows, they're queried again when re-used
+        
+        self.assertEqual([len(column) for column in context['columns']], [4, 3, 3], "Lazy stacked column lengths are incorrect")
+        
+        with self.assertNumQueries(3):
+            for column in context['columns']:
+                list(column)
+        
+        # Alternating
+        
+        expr = '{% columnize articles into 3 lazy as columns %}'
+        rendered, context = self.render(expr, {'articles': articles.order_by('-pk')})
+        
+        self.assertEqual([len(column) for column in context['columns']], [4, 3, 3], "Lazy column lengths are incorrect")
+        
+        # Each column scans the primary keys, then fetches its own rows in chunks
+        
+        context['columns'][0].chunk_size = 2
+        
+        with self.assertNumQueries(3 + 2 + 2):
+            columns = [[article.title for article in column] for column in context['columns']]
+        
+        self.assertEqual(columns, [['Article 9', 'Article 6', 'Article 3', 'Article 0'], ['Article 8', 'Article 5', 'Article 2'], ['Article 7', 'Article 4', 'Article 1']], "Lazy alternating columns were not sorted properly")
+        
+        # Lists are columnized as usual
+        
+        rendered, context = self.render(expr, {'articles': ['some', 'test', 'list', 'dude']})
+        self.assertEqual(context['columns'], [['some', 'dude'], ['test'], ['list']])
 
 class TruncateStringTagTestCase(BaseTestCase):
     
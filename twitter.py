@@ -1,7 +1,413 @@
-from datetime import datetime
+import httplib
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from Queue import Queue, Empty
 from urllib import urlencode
-from urllib2 import urlopen
+from urlparse import urlparse
 import simplejson
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from columns import chunk
+
+"""
+Twitter timeline client with pooled keep-alive connections, concurrent fetching and
+cached timelines that are refreshed in the background once they go stale.
+
+Settings (all optional):
+    
+    MACHETE_TWITTER_API_URL         Base API URL, e.g. to point at a local stand-in server for tests
+    MACHETE_TWITTER_CACHE_TIMEOUT   Seconds a cached timeline is fresh for, 0 to turn caching off (default 300)
+    MACHETE_TWITTER_STALE_TIMEOUT   Seconds a timeline is still served after that while it's refreshed (default 3600)
+    MACHETE_TWITTER_TIMELINES       Screen names, or (screen name, GET parameters dict) tuples, for the
+                                    'refresh_tweets' management command to keep warm
+    MACHETE_TWITTER_REFRESH_INTERVAL  Seconds between 'refresh_tweets' runs (default 60)
+
+"""
+
+API_URL = 'http://api.twitter.com/1/'
+
+class TwitterError(Exception):
+    pass
+
+class ConnectionPool(object):
+    
+    """
+    Keeps idle keep-alive HTTP connections around per host, so requests don't pay for
+    a new TCP connection each time
+    
+    `size`      Maximum number of idle connections kept per host
+    `timeout`   Socket timeout in seconds
+    """
+    
+    def __init__(self, size=4, timeout=5):
+        self.size = size
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+    
+    def request(self, url):
+        
+        """
+        GET `url` and return the response body, raising TwitterError if that fails
+        """
+        
+        parts = urlparse(url)
+        key = (parts.scheme, parts.hostname, parts.port,)
+        path = '%s?%s' % (parts.path, parts.query) if parts.query else parts.path
+        
+        # A pooled connection may have been closed by the server in the meantime, so give
+        # it one more go with a fresh connection if a reused one fails
+        
+        while True:
+            connection, reused = self._get(key)
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if not reused:
+                    raise TwitterError('Request to %s failed: %s' % (url, e))
+        
+        if response.will_close:
+            connection.close()
+        else:
+            self._put(key, connection)
+        
+        if response.status != 200:
+            raise TwitterError('Request to %s returned status %d' % (url, response.status))
+        
+        return body
+    
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        
+        scheme, host, port = key
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return connection_class(host, port, timeout=self.timeout), False
+    
+    def _put(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+class TwitterClient(object):
+    
+    """
+    Timeline client. Timelines are cached for `cache_timeout` seconds; after that they're
+    still served for up to `stale_timeout` more seconds while a background thread fetches
+    a fresh copy, so only the very first request for a timeline waits on Twitter.
+    
+    `api_url`       Base API URL, defaults to the MACHETE_TWITTER_API_URL setting or Twitter's
+    `timeout`       Socket timeout in seconds
+    `cache_timeout` Seconds a cached timeline is fresh for, 0 turns caching off
+    `stale_timeout` Seconds a timeline is served stale while it's being refreshed
+    `workers`       Number of concurrent requests for get_many(), and idle connections kept per host
+    `tweet_class`   Optional class to turn each tweet dict into, e.g. Tweet to save memory
+    """
+    
+    def __init__(self, api_url=None, timeout=5, cache_timeout=None, stale_timeout=None, workers=4, tweet_class=None):
+        self.api_url = api_url or getattr(settings, 'MACHETE_TWITTER_API_URL', API_URL)
+        self.cache_timeout = cache_timeout if cache_timeout is not None else getattr(settings, 'MACHETE_TWITTER_CACHE_TIMEOUT', 300)
+        self.stale_timeout = stale_timeout if stale_timeout is not None else getattr(settings, 'MACHETE_TWITTER_STALE_TIMEOUT', 3600)
+        self.workers = workers
+        self.tweet_class = tweet_class
+        self.pool = ConnectionPool(workers, timeout)
+    
+    def get_cache_key(self, screen_name, params):
+        data = '%s|%s|%s' % (self.api_url, screen_name.lower(), urlencode(sorted(params.items())))
+        return 'machete.twitter.%s' % md5_constructor(data).hexdigest()
+    
+    def fetch(self, screen_name, **kwargs):
+        
+        """
+        Fetch a user's timeline from the API, skipping (but updating) the cache.
+        Raises TwitterError if anything goes wrong.
+        """
+        
+        qs = kwargs.copy()
+        qs['screen_name'] = screen_name
+        url = '%sstatuses/user_timeline.json?%s' % (self.api_url, urlencode(qs))
+        
+        try:
+            tweets = parse_tweets(simplejson.loads(self.pool.request(url)), self.tweet_class)
+        except (ValueError, TypeError, KeyError), e:
+            raise TwitterError('Bad response from %s: %s' % (url, e))
+        
+        if self.cache_timeout:
+            cache.set(self.get_cache_key(screen_name, kwargs), (time.time(), tweets,), self.cache_timeout + self.stale_timeout)
+        
+        return tweets
+    
+    def get_tweets(self, screen_name, **kwargs):
+        
+        """
+        Get a user's timeline from the cache, or from the API if it's not cached yet.
+        Stale timelines are returned straight away and refreshed in the background.
+        Returns None if the timeline can't be fetched.
+        """
+        
+        if self.cache_timeout:
+            cached = cache.get(self.get_cache_key(screen_name, kwargs))
+            if cached is not None:
+                fetched, tweets = cached
+                if time.time() - fetched >= self.cache_timeout:
+                    self.refresh(screen_name, **kwargs)
+                return tweets
+        
+        try:
+            return self.fetch(screen_name, **kwargs)
+        except TwitterError:
+            return None
+    
+    def refresh(self, screen_name, **kwargs):
+        
+        """
+        Fetch a fresh copy of a timeline in a background thread, unless a refresh
+        for it is already under way (in any process sharing the cache)
+        """
+        
+        lock_key = '%s.refreshing' % self.get_cache_key(screen_name, kwargs)
+        
+        if not cache.add(lock_key, True, self.pool.timeout * 2):
+            return None
+        
+        def run():
+            try:
+                self.fetch(screen_name, **kwargs)
+            except TwitterError:
+                pass
+            finally:
+                cache.delete(lock_key)
+        
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+    
+    def get_cached(self, screen_name, **kwargs):
+        
+        """
+        Get a user's timeline straight from the cache, stale or not, without ever
+        touching the network. Returns None if it's not cached.
+        """
+        
+        cached = cache.get(self.get_cache_key(screen_name, kwargs))
+        return cached[1] if cached is not None else None
+    
+    def get_many(self, screen_names, **kwargs):
+        
+        """
+        Get the timelines for several users at once, fetching up to `workers` of them
+        concurrently. Returns a dict of screen name: tweets (or None).
+        """
+        
+        return self._map(lambda screen_name: self.get_tweets(screen_name, **kwargs), screen_names)
+    
+    def fetch_many(self, screen_names, **kwargs):
+        
+        """
+        Fetch the timelines for several users from the API at once, skipping (but updating) the
+        cache, up to `workers` of them concurrently. Returns a dict of screen name: tweets (or None).
+        """
+        
+        def fetch(screen_name):
+            try:
+                return self.fetch(screen_name, **kwargs)
+            except TwitterError:
+                return None
+        
+        return self._map(fetch, screen_names)
+    
+    def _map(self, func, screen_names):
+        
+        """
+        Call `func` for each screen name on up to `workers` threads, returning a dict of screen name: result
+        """
+        
+        results = {}
+        queue = Queue()
+        
+        for screen_name in set(screen_names):
+            queue.put(screen_name)
+        
+        def work():
+            while True:
+                try:
+                    screen_name = queue.get_nowait()
+                except Empty:
+                    return
+                results[screen_name] = func(screen_name)
+        
+        threads = [threading.Thread(target=work) for i in range(min(self.workers, queue.qsize()))]
+        
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        return results
+
+class TwitterRefresher(threading.Thread):
+    
+    """
+    Background thread keeping a set of timelines warm in the cache, so views can read them
+    with get_cached_tweets() and never wait on Twitter. Runs as a daemon thread, or in its own
+    process through the 'refresh_tweets' management command.
+    
+    `timelines`     List of screen names, or (screen name, GET parameters dict) tuples, to keep warm
+    `interval`      Seconds between refreshes, should be shorter than the client's cache_timeout
+    `batch_size`    Number of timelines fetched per batch, each batch fetched concurrently
+    `client`        TwitterClient to use, defaults to the shared one
+    """
+    
+    def __init__(self, timelines, interval=60, batch_size=20, client=None):
+        super(TwitterRefresher, self).__init__()
+        self.daemon = True
+        self.timelines = [timeline if isinstance(timeline, (list, tuple)) else (timeline, {}) for timeline in timelines]
+        self.interval = interval
+        self.batch_size = batch_size
+        self.client = client or get_client()
+        self.stopped = threading.Event()
+    
+    def refresh(self):
+        
+        """
+        Refresh every timeline once, returning the number that failed
+        """
+        
+        failed = 0
+        
+        # Group timelines with the same parameters so each group can be fetched concurrently
+        
+        groups = {}
+        
+        for screen_name, params in self.timelines:
+            groups.setdefault(tuple(sorted(params.items())), []).append(screen_name)
+        
+        for params, screen_names in groups.items():
+            for batch in chunk(screen_names, self.batch_size):
+                results = self.client.fetch_many(batch, **dict(params))
+                failed += len([tweets for tweets in results.values() if tweets is None])
+        
+        return failed
+    
+    def run(self):
+        while not self.stopped.is_set():
+            self.refresh()
+            self.stopped.wait(self.interval)
+    
+    def stop(self):
+        self.stopped.set()
+
+# ---- PARSING
+
+MONTHS = dict((month, i + 1) for i, month in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+def parse_created_at(value):
+    
+    """
+    Convert a 'Thu Dec 22 19:30:11 +0000 2011'-style date to a naive UTC datetime. Twitter's
+    format is fixed-width, so it's sliced apart instead of going through strptime(), which
+    is several times slower. Raises ValueError for anything else.
+    """
+    
+    try:
+        created = datetime(int(value[26:30]), MONTHS[value[4:7]], int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        offset = value[20:25]
+        if offset != '+0000':
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            created -= timedelta(minutes=-minutes if offset[0] == '-' else minutes)
+    except (KeyError, IndexError):
+        raise ValueError('Unrecognized date: %r' % value)
+    
+    return created
+
+class Tweet(object):
+    
+    """
+    Compact tweet record, for when lots of tweets are kept in memory or in the cache.
+    The usual fields are kept in slots and anything else in the `extra` dict. Fields can
+    be read as attributes or dict keys, so templates and code written for the raw
+    dicts keep working.
+    """
+    
+    __slots__ = ('id', 'text', 'created_at', 'user', 'entities', 'source', 'in_reply_to_screen_name',
+        'in_reply_to_status_id', 'retweet_count', 'retweeted_status', 'extra',)
+    
+    fields = __slots__[:-1]
+    
+    def __init__(self, data):
+        for field in self.fields:
+            setattr(self, field, data.pop(field, None))
+        self.extra = data
+    
+    def __getitem__(self, key):
+        if key in self.fields:
+            return getattr(self, key)
+        return self.extra[key]
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __eq__(self, other):
+        return isinstance(other, Tweet) and self.__getstate__() == other.__getstate__()
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return '<Tweet %s>' % self.id
+    
+    # Slots aren't picklable with the older pickle protocols some cache backends use
+    
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+    
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+def parse_tweets(tweets, tweet_class=None):
+    
+    """
+    Convert each tweet's 'created_at' to a Python datetime, in a single pass over the list.
+    If `tweet_class` (e.g. Tweet) is passed, each tweet dict is turned into one of those.
+    """
+    
+    if not tweets:
+        return tweets
+    
+    for tweet in tweets:
+        tweet['created_at'] = parse_created_at(tweet['created_at'])
+    
+    if tweet_class is not None:
+        return [tweet_class(tweet) for tweet in tweets]
+    
+    return tweets
+
+# Shared client for get_tweets()
+
+client = None
+
+def get_client():
+    global client
+    if client is None:
+        client = TwitterClient()
+    return client
 
 def get_tweets(screen_name, *args, **kwargs):
     
@@ -11,19 +417,17 @@ def get_tweets(screen_name, *args, **kwargs):
     
     https://dev.twitter.com/docs/api/1/get/statuses/user_timeline
     
+    Timelines are cached, see TwitterClient. Returns None if the timeline can't be fetched.
     """
     
-    try:
-        qs = kwargs.copy()
-        qs['screen_name'] = screen_name
-        url = 'http://api.twitter.com/1/statuses/user_timeline.json?%s' % urlencode(qs)
-        request = urlopen(url, None, 5)
-        tweets = simplejson.loads(request.read())
-        if tweets:
-            for tweet in tweets:
-                idx = tweets.index(tweet)
-                # Convert 'Thu Dec 22 19:30:11 +0000 2011'-style date to Python-friendly date
-                tweets[idx]['created_at'] = datetime.strptime(tweets[idx]['created_at'], '%a %b %d %H:%M:%S +0000 %Y')
-        return tweets
-    except:
-        return None
\ No newline at end of file
+    return get_client().get_tweets(screen_name, **kwargs)
+
+def get_cached_tweets(screen_name, **kwargs):
+    
+    """
+    Get tweets for a timeline kept warm by TwitterRefresher (or fetched earlier), straight from
+    the cache with 'created_at' already converted. Never touches the network; returns None if
+    the timeline isn't cached.
+    """
+    
+    return get_client().get_cached(screen_name, **kwargs)
\ No newline at end of file